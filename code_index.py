@@ -0,0 +1,178 @@
+# code_index.py
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Callable, Dict, Generator, Iterable, List, Optional, Tuple
+from code_symbols import extract_symbol_tables, module_name
+
+
+# bump when the stored symbol tables change, so existing indexes are rebuilt
+INDEX_VERSION = 3
+
+
+class CodeIndex:
+    def __init__(self, index_path: str):
+        """
+        A persistent SQLite index of Python files with their contents, contents hash and symbol table.
+        Only files whose mtime or size changed are re-read and re-parsed, so repeated runs over an unchanged
+        package skip all processing. Files are keyed by absolute path, so the index gives the same rows
+        whatever the working directory it is opened from.
+
+        Parameters
+        ----------
+        index_path : str
+            The SQLite database file, created if it does not exist.
+        """
+        self.index_path = index_path
+        self.connection = sqlite3.connect(index_path)
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+            self.connection.executescript(
+                "DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS imports;"
+            )
+            self.connection.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                root TEXT NOT NULL,
+                module TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                sha1 TEXT NOT NULL,
+                symbols TEXT NOT NULL,
+                content TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS files_root ON files (root);
+            """
+        )
+
+    def refresh(
+        self,
+        root_dir: str,
+        file_paths: List[str],
+        read_files: Callable[[List[str]], Iterable[Tuple[str, Optional[str]]]],
+        max_workers: Optional[int] = None,
+    ) -> Dict[str, float]:
+        """
+        Brings the index up to date with the files of a directory tree.
+
+        Parameters
+        ----------
+        root_dir : str
+            The root directory of the files.
+        file_paths : List[str]
+            All Python files currently in the directory tree.
+        read_files : Callable[[List[str]], Iterable[Tuple[str, Optional[str]]]]
+            Reads files, yielding (file_path, content) pairs, with None as content for a file that can not
+            be read; such a file is left out of the index and read again on the next refresh.
+        max_workers : int, optional
+            The number of processes parsing changed files (default is None, the number of CPUs).
+
+        Returns
+        -------
+        Dict[str, float]
+            The number of files, the number of re-parsed, touched (same content, new mtime), unreadable
+            and removed files, and the seconds it took.
+        """
+        start = time.time()
+        root = os.path.abspath(root_dir)
+        indexed = {
+            path: (mtime_ns, size, sha1)
+            for path, mtime_ns, size, sha1 in self.connection.execute(
+                "SELECT path, mtime_ns, size, sha1 FROM files WHERE root = ?", (root,)
+            )
+        }
+
+        changed = {}
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            path = os.path.abspath(file_path)
+            if indexed.get(path, (None, None))[:2] != (stat.st_mtime_ns, stat.st_size):
+                changed[file_path] = stat
+
+        to_parse = []
+        touched = 0
+        errors = 0
+        for file_path, content in read_files(list(changed)):
+            if content is None:
+                errors += 1
+                continue
+            sha1 = hashlib.sha1(content.encode("utf-8")).hexdigest()
+            stat = changed[file_path]
+            path = os.path.abspath(file_path)
+            if path in indexed and indexed[path][2] == sha1:
+                touched += 1
+                self.connection.execute(
+                    "UPDATE files SET mtime_ns = ?, size = ? WHERE path = ?",
+                    (stat.st_mtime_ns, stat.st_size, path),
+                )
+            else:
+                to_parse.append((file_path, content, sha1))
+
+        tables = extract_symbol_tables(
+            [
+                (file_path, content, module_name(file_path, root_dir))
+                for file_path, content, _ in to_parse
+            ],
+            max_workers if len(to_parse) > 16 else 1,
+        )
+        for (file_path, content, sha1), table in zip(to_parse, tables):
+            stat = changed[file_path]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    os.path.abspath(file_path),
+                    root,
+                    table["module"],
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                    sha1,
+                    json.dumps(table),
+                    content,
+                ),
+            )
+
+        removed = set(indexed) - {os.path.abspath(file_path) for file_path in file_paths}
+        for path in removed:
+            self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+        self.connection.commit()
+
+        return {
+            "files": len(file_paths),
+            "parsed": len(to_parse),
+            "touched": touched,
+            "errors": errors,
+            "removed": len(removed),
+            "seconds": time.time() - start,
+        }
+
+    def contents(self, file_paths: List[str]) -> Generator[Tuple[str, str], None, None]:
+        """
+        Yields the (file_path, content) of the files, one at a time.
+        """
+        for file_path in file_paths:
+            row = self.connection.execute(
+                "SELECT content FROM files WHERE path = ?", (os.path.abspath(file_path),)
+            ).fetchone()
+            if row is not None:
+                yield file_path, row[0]
+
+    def symbol_tables(self, file_paths: List[str]) -> List[Dict]:
+        """
+        Returns the symbol tables of the files, see code_symbols.extract_symbols.
+        """
+        tables = []
+        for file_path in file_paths:
+            row = self.connection.execute(
+                "SELECT symbols FROM files WHERE path = ?", (os.path.abspath(file_path),)
+            ).fetchone()
+            if row is not None:
+                # the path as the caller knows it, which may differ from the one it was parsed under
+                tables.append({**json.loads(row[0]), "path": file_path})
+        return tables
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,260 @@
+# code_retrieval.py
+
+import hashlib
+import json
+import os
+import re
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+import numpy as np
+from scipy import sparse
+from get_code_content import approximate_token_count
+
+
+WORD_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+CAMEL_CASE_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits text into lowercase search terms. Identifiers are kept whole and also split into their
+    snake_case and camelCase parts, so "get_code_content" matches a question about "code content".
+    """
+    terms = []
+    for word in WORD_PATTERN.findall(text):
+        parts = [part for piece in word.split("_") for part in CAMEL_CASE_PATTERN.findall(piece)]
+        terms.append(word.lower())
+        if len(parts) > 1:
+            terms.extend(part.lower() for part in parts)
+    return terms
+
+
+def build_chunks(tables: List[Dict], contents: Dict[str, str]) -> List[Dict]:
+    """
+    Splits files into symbol-level chunks: one per function and method, one per class with everything
+    except its methods, and one per file with everything outside its classes and functions.
+
+    Parameters
+    ----------
+    tables : List[Dict]
+        The symbol tables of the files, see code_symbols.extract_symbols.
+    contents : Dict[str, str]
+        The content of every file by path.
+
+    Returns
+    -------
+    List[Dict]
+        The chunks with the keys path, qualname (None for the file chunk), lineno and text.
+    """
+    chunks = []
+    for table in tables:
+        if table["error"] is not None:
+            continue
+        lines = contents[table["path"]].split("\n")
+        symbols = table["symbols"]
+        owned = {}
+        for symbol in symbols:
+            # every line belongs to the innermost symbol containing it
+            for index in range(symbol["lineno"] - 1, symbol["end_lineno"]):
+                owned[index] = symbol["qualname"]
+
+        by_owner = {}
+        for index, line in enumerate(lines):
+            by_owner.setdefault(owned.get(index), []).append(line)
+        first_line = {symbol["qualname"]: symbol["lineno"] for symbol in symbols}
+        for qualname, owner_lines in by_owner.items():
+            text = "\n".join(owner_lines).strip("\n")
+            if text:
+                chunks.append(
+                    {
+                        "path": table["path"],
+                        "qualname": qualname,
+                        "lineno": first_line.get(qualname, 1),
+                        "text": text,
+                    }
+                )
+    return chunks
+
+
+class CodeRetriever:
+    def __init__(self, chunks: List[Dict], k1: float = 1.2, b: float = 0.75):
+        """
+        A BM25 index over code chunks, stored as a sparse document-term matrix of precomputed BM25 weights,
+        so scoring a question is a single sparse matrix-vector product.
+
+        Parameters
+        ----------
+        chunks : List[Dict]
+            The chunks as returned by build_chunks.
+        k1 : float, optional
+            The BM25 term frequency saturation (default is 1.2).
+        b : float, optional
+            The BM25 document length normalization (default is 0.75).
+        """
+        self.chunks = chunks
+        self.fingerprint = None
+        self.vocabulary: Dict[str, int] = {}
+
+        rows, columns, counts = [], [], []
+        lengths = np.zeros(len(chunks))
+        for row, chunk in enumerate(chunks):
+            # the location of a chunk is searchable as well
+            terms = tokenize(f"{chunk['path']} {chunk['qualname'] or ''} {chunk['text']}")
+            lengths[row] = len(terms)
+            for term, count in Counter(terms).items():
+                rows.append(row)
+                columns.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+                counts.append(count)
+
+        term_frequencies = sparse.csr_matrix(
+            (np.asarray(counts, dtype=np.float64), (rows, columns)),
+            shape=(len(chunks), len(self.vocabulary)),
+        )
+        document_frequencies = np.bincount(
+            term_frequencies.indices, minlength=len(self.vocabulary)
+        )
+        idf = np.log1p((len(chunks) - document_frequencies + 0.5) / (document_frequencies + 0.5))
+
+        # BM25 weight of every (chunk, term) pair, computed on the non-zero entries only
+        average_length = lengths.mean() if len(chunks) else 0.0
+        row_lengths = np.repeat(lengths, np.diff(term_frequencies.indptr))
+        tf = term_frequencies.data
+        norm = k1 * (1 - b + b * row_lengths / max(average_length, 1.0))
+        weights = term_frequencies.copy()
+        weights.data = idf[term_frequencies.indices] * tf * (k1 + 1) / (tf + norm)
+        # column slicing in search is fastest on a CSC matrix
+        self.weights = weights.tocsc()
+
+    def search(self, question: str, top_k: int = 20) -> List[Dict]:
+        """
+        Returns the top_k chunks most relevant to the question, best first, each with its BM25 score.
+        """
+        columns = [self.vocabulary[term] for term in set(tokenize(question)) if term in self.vocabulary]
+        if not columns:
+            return []
+        scores = np.asarray(self.weights[:, columns].sum(axis=1)).ravel()
+        top_k = min(top_k, int(np.count_nonzero(scores)))
+        best = np.argpartition(-scores, top_k - 1)[:top_k] if top_k else []
+        best = sorted(best, key=lambda index: -scores[index])
+        return [{**self.chunks[index], "score": float(scores[index])} for index in best]
+
+    def build_context(
+        self,
+        question: str,
+        tree: str,
+        top_k: int = 20,
+        max_tokens: Optional[int] = None,
+        count_tokens: Callable[[str], int] = approximate_token_count,
+    ) -> str:
+        """
+        Builds prompt content for a question from the directory tree and the most relevant chunks,
+        ordered by file and line so related code stays together.
+
+        Parameters
+        ----------
+        question : str
+            The question about the code.
+        tree : str
+            The directory tree, e.g. "\\n".join(organizer.generate_directory_tree()).
+        top_k : int, optional
+            The number of chunks (default is 20).
+        max_tokens : int, optional
+            The token budget of the content, tree included; chunks are added best first and a chunk that
+            does not fit is skipped (default is None, no budget).
+        count_tokens : Callable[[str], int], optional
+            Counts the tokens of a part (default is approximate_token_count).
+
+        Returns
+        -------
+        str
+            The directory tree followed by the relevant chunks.
+        """
+        parts = ["DIRECTORY TREE STRUCTURE:", tree, "", "RELEVANT CODE:"]
+        tokens = count_tokens("\n".join(parts))
+        selected = []
+        for chunk in self.search(question, top_k):
+            location = f"{chunk['path']}:{chunk['lineno']}"
+            text = f"# {location} {chunk['qualname'] or '(module level)'}\n{chunk['text']}"
+            chunk_tokens = count_tokens(text) + 1
+            if max_tokens is not None and tokens + chunk_tokens > max_tokens:
+                continue
+            tokens += chunk_tokens
+            selected.append((chunk["path"], chunk["lineno"], text))
+        parts.extend(text for _, _, text in sorted(selected))
+        return "\n".join(parts)
+
+    def save(self, index_dir: str) -> None:
+        """
+        Saves the index to a directory, as a sparse matrix and a JSON file with the vocabulary and chunks.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        sparse.save_npz(os.path.join(index_dir, "bm25_weights.npz"), self.weights)
+        with open(os.path.join(index_dir, "bm25_index.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {"fingerprint": self.fingerprint, "vocabulary": self.vocabulary, "chunks": self.chunks}, f
+            )
+
+    @classmethod
+    def load(cls, index_dir: str) -> Optional["CodeRetriever"]:
+        """
+        Loads an index saved with save, or returns None if there is none.
+        """
+        json_path = os.path.join(index_dir, "bm25_index.json")
+        weights_path = os.path.join(index_dir, "bm25_weights.npz")
+        if not (os.path.isfile(json_path) and os.path.isfile(weights_path)):
+            return None
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        retriever = cls.__new__(cls)
+        retriever.chunks = data["chunks"]
+        retriever.vocabulary = data["vocabulary"]
+        retriever.fingerprint = data["fingerprint"]
+        retriever.weights = sparse.load_npz(weights_path).tocsc()
+        return retriever
+
+
+def files_fingerprint(file_paths: List[str]) -> str:
+    """
+    Returns a hash of the paths, mtimes and sizes of the files, which changes when any file changes.
+    """
+    digest = hashlib.sha1()
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        digest.update(f"{file_path}\0{stat.st_mtime_ns}\0{stat.st_size}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_or_build_retriever(
+    organizer, index_dir: str, file_paths: Optional[List[str]] = None
+) -> CodeRetriever:
+    """
+    Loads the retriever of a CodeContentOrganizer's directory tree from index_dir, rebuilding and saving
+    it when any file changed since it was built.
+
+    Parameters
+    ----------
+    organizer : CodeContentOrganizer
+        The organizer of the code to retrieve from.
+    index_dir : str
+        The directory of the persisted index.
+    file_paths : List[str], optional
+        The file paths of a previous organizer.scan() (default is None, scanning the directory tree).
+
+    Returns
+    -------
+    CodeRetriever
+        The up-to-date retriever.
+    """
+    if file_paths is None:
+        _, file_paths = organizer.scan()
+    fingerprint = files_fingerprint(file_paths)
+    retriever = CodeRetriever.load(index_dir)
+    if retriever is not None and retriever.fingerprint == fingerprint:
+        return retriever
+
+    tables = organizer.get_symbol_tables(file_paths=file_paths)
+    contents = dict(organizer.generate_file_contents(file_paths))
+    retriever = CodeRetriever(build_chunks(tables, contents))
+    retriever.fingerprint = fingerprint
+    retriever.save(index_dir)
+    return retriever
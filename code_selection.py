@@ -0,0 +1,150 @@
+# code_selection.py
+
+from typing import Callable, Dict, List, Optional
+
+
+def build_units(
+    tables: List[Dict], contents: Dict[str, str], count_tokens: Callable[[str], int]
+) -> List[Dict]:
+    """
+    Splits files into selectable units: one header unit per file with everything outside its top-level
+    classes and functions (imports, constants, module docstring), and one unit per top-level class or function.
+
+    Parameters
+    ----------
+    tables : List[Dict]
+        The symbol tables of the files, see code_symbols.extract_symbols.
+    contents : Dict[str, str]
+        The content of every file by path.
+    count_tokens : Callable[[str], int]
+        Counts the tokens of a unit.
+
+    Returns
+    -------
+    List[Dict]
+        The units with the keys path, module, name (None for headers), segments (the (first line, text) of
+        every contiguous run of lines), text, cost and requires (the index of the header unit the unit
+        depends on, None for headers).
+    """
+    units = []
+    for table in tables:
+        lines = contents[table["path"]].split("\n")
+        spans = [
+            (symbol["lineno"] - 1, symbol["end_lineno"], symbol["name"])
+            for symbol in table["symbols"]
+            if symbol["depth"] == 0
+        ]
+        covered = set()
+        for start, end, _ in spans:
+            covered.update(range(start, end))
+
+        header_segments = []
+        run_start = None
+        for index in range(len(lines) + 1):
+            if index < len(lines) and index not in covered:
+                run_start = index if run_start is None else run_start
+            elif run_start is not None:
+                header_segments.append((run_start, "\n".join(lines[run_start:index])))
+                run_start = None
+
+        header_index = len(units)
+        header = "\n".join(text for _, text in header_segments)
+        units.append(
+            {
+                "path": table["path"],
+                "module": table["module"],
+                "name": None,
+                "segments": header_segments,
+                "text": header,
+                "cost": count_tokens(header),
+                "requires": None,
+            }
+        )
+        for start, end, name in spans:
+            text = "\n".join(lines[start:end])
+            units.append(
+                {
+                    "path": table["path"],
+                    "module": table["module"],
+                    "name": name,
+                    "segments": [(start, text)],
+                    "text": text,
+                    "cost": count_tokens(text),
+                    "requires": header_index,
+                }
+            )
+    return units
+
+
+def select_units(units: List[Dict], scores: List[float], budget: int) -> List[int]:
+    """
+    Selects the subset of units with the highest total score that fits the budget, in a single greedy pass
+    over the units ordered by score per unit of cost (the classic knapsack approximation).
+    Selecting a unit also selects the header unit it requires, whose cost is counted on first use.
+
+    Parameters
+    ----------
+    units : List[Dict]
+        The units with their cost and requires.
+    scores : List[float]
+        The score of every unit.
+    budget : int
+        The maximum total cost.
+
+    Returns
+    -------
+    List[int]
+        The indices of the selected units, in their original order.
+    """
+    order = sorted(
+        range(len(units)), key=lambda index: scores[index] / max(units[index]["cost"], 1), reverse=True
+    )
+    selected = set()
+    remaining = budget
+    for index in order:
+        if index in selected:
+            continue
+        required = units[index]["requires"]
+        cost = units[index]["cost"]
+        if required is not None and required not in selected:
+            cost += units[required]["cost"]
+        if cost > remaining:
+            continue
+        selected.add(index)
+        if required is not None:
+            selected.add(required)
+        remaining -= cost
+    return sorted(selected)
+
+
+def render_units(
+    units: List[Dict], selected: List[int], header: Optional[str] = "{path}"
+) -> str:
+    """
+    Renders the selected units per file, in file order and with their lines in the original order.
+
+    Parameters
+    ----------
+    units : List[Dict]
+        The units as returned by build_units.
+    selected : List[int]
+        The indices of the selected units, in their original order.
+    header : str, optional
+        The format of the line preceding every file, with {path} and {module} as fields (default is "{path}").
+
+    Returns
+    -------
+    str
+        The content of the selected units.
+    """
+    files = {}
+    for index in selected:
+        unit = units[index]
+        files.setdefault((unit["path"], unit["module"]), []).extend(unit["segments"])
+
+    parts = []
+    for (path, module), segments in files.items():
+        if header is not None:
+            parts.append(header.format(path=path, module=module))
+        parts.extend(text for _, text in sorted(segments, key=lambda segment: segment[0]))
+    return "\n".join(parts)
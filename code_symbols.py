@@ -0,0 +1,259 @@
+# code_symbols.py
+
+import ast
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+def module_name(file_path: str, root_dir: str) -> str:
+    """
+    Returns the dotted module name of a file, with the name of root_dir as top-level package.
+    For example "site-packages/accelerate/utils/memory.py" with root "site-packages/accelerate"
+    becomes "accelerate.utils.memory", and a package's __init__.py gets the name of the package.
+    """
+    root_dir = os.path.abspath(root_dir)
+    relative_path = os.path.relpath(os.path.abspath(file_path), root_dir)
+    parts = [os.path.basename(root_dir)] + relative_path[: -len(".py")].split(os.sep)
+    if parts[-1] == "__init__":
+        parts = parts[:-1]
+    return ".".join(parts)
+
+
+def resolve_import(module: str, is_package: bool, target: Optional[str], level: int) -> str:
+    """
+    Resolves a (relative) import to an absolute module name.
+
+    Parameters
+    ----------
+    module : str
+        The dotted name of the importing module.
+    is_package : bool
+        Whether the importing module is a package (__init__.py).
+    target : str, optional
+        The imported module as written, without leading dots (None for "from . import x").
+    level : int
+        The number of leading dots of the import.
+
+    Returns
+    -------
+    str
+        The absolute module name.
+    """
+    if level == 0:
+        return target or ""
+    parts = module.split(".")
+    if not is_package:
+        parts = parts[:-1]
+    if level > 1:
+        parts = parts[: -(level - 1)]
+    return ".".join(parts + ([target] if target else []))
+
+
+def _signature(node: ast.AST) -> str:
+    if isinstance(node, ast.ClassDef):
+        bases = [ast.unparse(base) for base in node.bases] + [
+            ast.unparse(keyword) for keyword in node.keywords
+        ]
+        return f"class {node.name}({', '.join(bases)}):" if bases else f"class {node.name}:"
+    prefix = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+    returns = f" -> {ast.unparse(node.returns)}" if node.returns else ""
+    return f"{prefix} {node.name}({ast.unparse(node.args)}){returns}:"
+
+
+def _dotted_name(node: ast.AST) -> Optional[str]:
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        value = _dotted_name(node.value)
+        return f"{value}.{node.attr}" if value else None
+    return None
+
+
+def _calls(node: ast.AST) -> List[str]:
+    # calls of nested functions and lambdas are attributed to the enclosing function
+    calls = {
+        _dotted_name(child.func)
+        for child in ast.walk(node)
+        if isinstance(child, ast.Call)
+    }
+    calls.discard(None)
+    return sorted(calls)
+
+
+def _collect_symbols(
+    body: List[ast.stmt], parent: Optional[str], in_class: bool, symbols: List[Dict]
+) -> None:
+    for node in body:
+        if not isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        qualname = f"{parent}.{node.name}" if parent else node.name
+        if isinstance(node, ast.ClassDef):
+            kind = "class"
+        else:
+            kind = "method" if in_class else "function"
+        symbols.append(
+            {
+                "kind": kind,
+                "name": node.name,
+                "qualname": qualname,
+                "depth": qualname.count("."),
+                "signature": _signature(node),
+                "decorators": ["@" + ast.unparse(d) for d in node.decorator_list],
+                "docstring": ast.get_docstring(node),
+                # decorators belong to the span of the definition
+                "lineno": min([node.lineno] + [d.lineno for d in node.decorator_list]),
+                "end_lineno": node.end_lineno,
+                "calls": [] if isinstance(node, ast.ClassDef) else _calls(node),
+            }
+        )
+        # nested functions are implementation details, nested classes and methods are not
+        if isinstance(node, ast.ClassDef):
+            _collect_symbols(node.body, qualname, True, symbols)
+
+
+def extract_symbols(file_path: str, source: str, module: str = "") -> Dict:
+    """
+    Extracts the symbol table of a Python file.
+
+    Parameters
+    ----------
+    file_path : str
+        The path of the file, stored in the table to keep track of where symbols come from.
+    source : str
+        The source code of the file.
+    module : str, optional
+        The dotted module name of the file, used for resolving relative imports (default is "").
+
+    Returns
+    -------
+    Dict
+        The symbol table with the keys path, module, docstring, imports, aliases (local name to the absolute
+        name it was imported as), symbols, lines and error.
+        Every symbol has a kind (class, function or method), name, qualname, depth, signature,
+        decorators, docstring, its line span (lineno, end_lineno) and the dotted names it calls.
+    """
+    table = {
+        "path": file_path,
+        "module": module,
+        "docstring": None,
+        "imports": [],
+        "aliases": {},
+        "symbols": [],
+        "lines": source.count("\n") + 1,
+        "error": None,
+    }
+    try:
+        tree = ast.parse(source, filename=file_path)
+    except (SyntaxError, ValueError) as e:
+        table["error"] = f"{type(e).__name__}: {e}"
+        return table
+
+    is_package = os.path.basename(file_path) == "__init__.py"
+    table["docstring"] = ast.get_docstring(tree)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                table["imports"].append({"module": alias.name, "names": []})
+                if alias.asname:
+                    table["aliases"][alias.asname] = alias.name
+                else:
+                    # "import a.b" binds "a"
+                    top_level = alias.name.split(".")[0]
+                    table["aliases"][top_level] = top_level
+        elif isinstance(node, ast.ImportFrom):
+            imported = resolve_import(module, is_package, node.module, node.level)
+            table["imports"].append(
+                {"module": imported, "names": [alias.name for alias in node.names]}
+            )
+            for alias in node.names:
+                if alias.name != "*":
+                    table["aliases"][alias.asname or alias.name] = f"{imported}.{alias.name}"
+    _collect_symbols(tree.body, None, False, table["symbols"])
+    return table
+
+
+def _extract_symbols_star(args: Tuple[str, str, str]) -> Dict:
+    return extract_symbols(*args)
+
+
+def extract_symbol_tables(
+    files: Iterable[Tuple[str, str, str]],
+    max_workers: Optional[int] = None,
+    chunksize: int = 16,
+) -> List[Dict]:
+    """
+    Extracts the symbol tables of many files, parsing them in parallel on a process pool.
+
+    Parameters
+    ----------
+    files : Iterable[Tuple[str, str, str]]
+        The (file_path, source, module) of every file.
+    max_workers : int, optional
+        The number of processes (default is None, the number of CPUs). With 1 the files are parsed
+        in this process, which is faster for small packages.
+    chunksize : int, optional
+        The number of files sent to a process at once (default is 16).
+
+    Returns
+    -------
+    List[Dict]
+        The symbol tables, in the order of the input.
+    """
+    if max_workers == 1:
+        return [_extract_symbols_star(args) for args in files]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_extract_symbols_star, files, chunksize=chunksize))
+
+
+def _indent(text: str, prefix: str) -> str:
+    return "\n".join(prefix + line if line else line for line in text.split("\n"))
+
+
+def render_skeleton(
+    tables: List[Dict],
+    header: Optional[str] = "{path}",
+    max_docstring_lines: Optional[int] = None,
+) -> str:
+    """
+    Renders symbol tables as a compact code skeleton: signatures with annotations, decorators and docstrings,
+    without implementations.
+
+    Parameters
+    ----------
+    tables : List[Dict]
+        The symbol tables as returned by extract_symbols.
+    header : str, optional
+        The format of the line preceding every file, with {path} and {module} as fields (default is "{path}").
+        None omits the line.
+    max_docstring_lines : int, optional
+        Truncate docstrings to this number of lines (default is None, full docstrings).
+
+    Returns
+    -------
+    str
+        The skeleton of all files.
+    """
+
+    def docstring(text: Optional[str], prefix: str) -> List[str]:
+        if not text:
+            return []
+        lines = text.split("\n")
+        if max_docstring_lines is not None and len(lines) > max_docstring_lines:
+            lines = lines[:max_docstring_lines] + ["..."]
+        return [_indent('"""' + "\n".join(lines) + '"""', prefix)]
+
+    parts = []
+    for table in tables:
+        if header is not None:
+            parts.append(header.format(path=table["path"], module=table["module"]))
+        if table["error"] is not None:
+            parts.append(f"# could not parse: {table['error']}")
+            continue
+        parts.extend(docstring(table["docstring"], ""))
+        for symbol in table["symbols"]:
+            prefix = "    " * symbol["depth"]
+            parts.extend(prefix + decorator for decorator in symbol["decorators"])
+            parts.append(prefix + symbol["signature"])
+            parts.extend(docstring(symbol["docstring"], prefix + "    "))
+    return "\n".join(parts)
@@ -1,5 +1,6 @@
 from typing import List, Dict
 from transformers import PreTrainedTokenizer
+from tracing import traced
 
 class ContextManagement:
 
@@ -25,6 +26,7 @@ class ContextManagement:
         tokens = self.tokenizer.encode(content, max_length=num_tokens, truncation=True)
         return self.tokenizer.decode(tokens)
 
+    @traced("ctx.manage_context")
     def __manage_context__(self, messages: List[Dict]) -> List[Dict]:
         managed_messages = []
         system_message = None
@@ -60,6 +62,7 @@ class ContextManagement:
             managed_messages.insert(0, system_message)
         return managed_messages
 
+    @traced("ctx.apply_chat_template")
     def __create_message_input__(self, messages: List[Dict]) -> str:
         return self.tokenizer.apply_chat_template(messages, tokenize=False)
 
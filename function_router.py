@@ -0,0 +1,166 @@
+# function_router.py
+
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+
+NO_FUNCTION = "none"
+
+
+def ngrams(text: str, sizes: Tuple[int, ...] = (3, 4, 5)) -> List[str]:
+    """
+    Returns the words and character n-grams of the words in a text, which makes matching robust
+    to inflections and typos ("sql-query", "SQL query's", "execute_sql").
+    """
+    words = re.findall(r"\w+", text.lower().replace("_", " "))
+    features = list(words)
+    for word in words:
+        padded = f" {word} "
+        for size in sizes:
+            features.extend(padded[i : i + size] for i in range(len(padded) - size + 1))
+    return features
+
+
+class FunctionRouter:
+    def __init__(
+        self,
+        functions: Dict[str, Dict],
+        accept_score: float = 0.45,
+        reject_score: float = 0.15,
+        min_margin: float = 0.1,
+    ):
+        """
+        Routes questions to functions with a TF-IDF index over character n-grams of the function names,
+        descriptions and example phrasings. The index is built once, so routing a question costs one sparse
+        lookup and a small matrix-vector product.
+
+        Parameters
+        ----------
+        functions : Dict[str, Dict]
+            Per function name a dict with a "description" and a list of "examples" of questions that
+            should call the function.
+        accept_score : float, optional
+            The cosine similarity above which the best function is called without asking the LLM,
+            provided it beats the runner-up by min_margin (default is 0.45).
+        reject_score : float, optional
+            The cosine similarity below which no function is called (default is 0.15).
+        min_margin : float, optional
+            The minimum difference between the best and second best function to accept directly (default is 0.1).
+        """
+        self.names = list(functions)
+        self.accept_score = accept_score
+        self.reject_score = reject_score
+        self.min_margin = min_margin
+
+        # every phrasing is a separate row, a function scores as its best matching phrasing
+        documents, self.row_names = [], []
+        for name, spec in functions.items():
+            for text in [f"{name} {spec.get('description', '')}"] + list(spec.get("examples", [])):
+                documents.append(Counter(ngrams(text)))
+                self.row_names.append(name)
+
+        self.vocabulary: Dict[str, int] = {}
+        for document in documents:
+            for feature in document:
+                self.vocabulary.setdefault(feature, len(self.vocabulary))
+        document_frequency = np.zeros(len(self.vocabulary))
+        for document in documents:
+            document_frequency[[self.vocabulary[feature] for feature in document]] += 1
+        self.idf = np.log((1 + len(documents)) / (1 + document_frequency)) + 1
+
+        self.matrix = np.zeros((len(documents), len(self.vocabulary)))
+        for row, document in enumerate(documents):
+            for feature, count in document.items():
+                self.matrix[row, self.vocabulary[feature]] = count
+        self.matrix *= self.idf
+        self.matrix /= np.linalg.norm(self.matrix, axis=1, keepdims=True)
+
+    def scores(self, question: str) -> Dict[str, float]:
+        """
+        Returns the cosine similarity between the question and every function.
+        """
+        features = ngrams(question)
+        counts = Counter(feature for feature in features if feature in self.vocabulary)
+        result = dict.fromkeys(self.names, 0.0)
+        if not counts:
+            return result
+        columns = np.fromiter((self.vocabulary[feature] for feature in counts), dtype=np.int64)
+        weights = np.fromiter(counts.values(), dtype=np.float64) * self.idf[columns]
+        # features outside the vocabulary still count towards the length of the question
+        norm = np.sqrt((weights**2).sum() + len(features) - sum(counts.values()))
+        row_scores = self.matrix[:, columns] @ weights / norm
+        for name, score in zip(self.row_names, row_scores):
+            result[name] = max(result[name], float(score))
+        return result
+
+    def route(self, question: str) -> Tuple[Optional[str], bool]:
+        """
+        Routes a question.
+
+        Parameters
+        ----------
+        question : str
+            The question of the user.
+
+        Returns
+        -------
+        Tuple[Optional[str], bool]
+            The function to call (None for no function) and whether the decision is ambiguous and
+            should be left to the LLM, see choose_function_with_llm.
+        """
+        ranked = sorted(self.scores(question).items(), key=lambda item: item[1], reverse=True)
+        if not ranked or ranked[0][1] < self.reject_score:
+            return None, False
+        best, best_score = ranked[0]
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+        if best_score >= self.accept_score and best_score - runner_up >= self.min_margin:
+            return best, False
+        return best, True
+
+    def grammar(self) -> str:
+        """
+        Returns a GBNF grammar that only allows the name of one of the functions followed by "()",
+        or "none" when no function applies.
+        """
+        options = " | ".join(f'"{name}()"' for name in self.names)
+        return f'root ::= {options} | "{NO_FUNCTION}"'
+
+    def choose_function_with_llm(self, llm, question: str) -> Optional[str]:
+        """
+        Lets the LLM choose the function for an ambiguous question. Decoding is constrained by the grammar,
+        so the output is always a valid choice and generation stops after a handful of tokens.
+
+        Parameters
+        ----------
+        llm : LLM
+            The language model.
+        question : str
+            The question of the user.
+
+        Returns
+        -------
+        Optional[str]
+            The chosen function, or None when the LLM decides no function applies.
+        """
+        from llama_cpp import LlamaGrammar
+
+        prompt = (
+            "Kies de functie die de vraag van de gebruiker uitvoert, of 'none' als geen functie past. "
+            "Functies: "
+            + "; ".join(self.names)
+        )
+        messages = [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": f"Vraag: {question}"},
+        ]
+        max_tokens = max(len(name) for name in self.names + [NO_FUNCTION]) // 2 + 4
+        output = llm.complete(
+            messages,
+            grammar=LlamaGrammar.from_string(self.grammar(), verbose=False),
+            max_tokens=max_tokens,
+            temperature=0.0,
+        )
+        choice = output.strip().removesuffix("()")
+        return choice if choice in self.names else None
@@ -0,0 +1,231 @@
+# generation_stopping.py
+
+import abc
+import time
+from typing import Dict, List, Optional, Tuple
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+
+class RecordingStoppingCriteria(StoppingCriteria, abc.ABC):
+    """
+    Base class for stopping criteria that remember whether they stopped the generation,
+    how many tokens were generated and the last generated token.
+
+    Parameters
+    ----------
+    prompt_length : int
+        The number of prompt tokens in input_ids, which are not counted as generated tokens.
+    """
+
+    reason = "stopped"
+
+    def __init__(self, prompt_length: int):
+        self.prompt_length = prompt_length
+        self.new_tokens = 0
+        self.last_token: Optional[int] = None
+        self.triggered = False
+
+    @abc.abstractmethod
+    def should_stop(self, input_ids: torch.LongTensor) -> bool:
+        """
+        Returns whether the generation should stop after the last token of input_ids.
+        """
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        self.new_tokens = input_ids.shape[1] - self.prompt_length
+        self.last_token = int(input_ids[0, -1])
+        stop = self.should_stop(input_ids)
+        self.triggered = self.triggered or stop
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+
+class NGramRepetitionCriteria(RecordingStoppingCriteria):
+    """
+    Stops when the last generated n-gram has already been generated max_repeats times,
+    which catches models looping over the same lines or table rows.
+
+    Parameters
+    ----------
+    prompt_length : int
+        The number of prompt tokens in input_ids.
+    ngram_size : int, optional
+        The number of tokens of an n-gram (default is 30).
+    max_repeats : int, optional
+        The number of occurrences of an n-gram that stops the generation (default is 4).
+    """
+
+    reason = "repetition"
+
+    def __init__(self, prompt_length: int, ngram_size: int = 30, max_repeats: int = 4):
+        super().__init__(prompt_length)
+        self.ngram_size = ngram_size
+        self.max_repeats = max_repeats
+        self.counts: Dict[Tuple[int, ...], int] = {}
+
+    def should_stop(self, input_ids: torch.LongTensor) -> bool:
+        if self.new_tokens < self.ngram_size:
+            return False
+        # batch size is 1 for OCR, so only the first sequence is tracked
+        ngram = tuple(input_ids[0, -self.ngram_size :].tolist())
+        self.counts[ngram] = self.counts.get(ngram, 0) + 1
+        return self.counts[ngram] >= self.max_repeats
+
+
+class TokenBudgetCriteria(RecordingStoppingCriteria):
+    """
+    Stops when the number of generated tokens reaches the budget.
+
+    Parameters
+    ----------
+    prompt_length : int
+        The number of prompt tokens in input_ids.
+    max_tokens : int
+        The maximum number of generated tokens.
+    """
+
+    reason = "token_budget"
+
+    def __init__(self, prompt_length: int, max_tokens: int):
+        super().__init__(prompt_length)
+        self.max_tokens = max_tokens
+
+    def should_stop(self, input_ids: torch.LongTensor) -> bool:
+        return self.new_tokens >= self.max_tokens
+
+
+class WallClockCriteria(RecordingStoppingCriteria):
+    """
+    Stops when the generation takes longer than timeout seconds, measured from the creation of the criteria.
+
+    Parameters
+    ----------
+    prompt_length : int
+        The number of prompt tokens in input_ids.
+    timeout : float
+        The maximum generation time in seconds.
+    """
+
+    reason = "timeout"
+
+    def __init__(self, prompt_length: int, timeout: float):
+        super().__init__(prompt_length)
+        self.deadline = time.monotonic() + timeout
+
+    def should_stop(self, input_ids: torch.LongTensor) -> bool:
+        return time.monotonic() >= self.deadline
+
+
+class DegenerationGuard:
+    def __init__(
+        self,
+        ngram_size: Optional[int] = 30,
+        max_repeats: int = 4,
+        base_tokens: int = 300,
+        tokens_per_megapixel: Optional[int] = 800,
+        timeout: Optional[float] = None,
+    ):
+        """
+        Creates the stopping criteria for a single image generation, which stop looping or runaway generations
+        long before max_new_tokens. Every criterion can be disabled by setting its parameter to None.
+
+        Parameters
+        ----------
+        ngram_size : int, optional
+            The n-gram size for repetition detection (default is 30).
+        max_repeats : int, optional
+            The number of occurrences of an n-gram that is considered a loop (default is 4).
+        base_tokens : int, optional
+            The token budget of an image regardless of its size (default is 300).
+        tokens_per_megapixel : int, optional
+            The token budget added per megapixel of the image (default is 800).
+        timeout : float, optional
+            The maximum generation time per image in seconds (default is None).
+        """
+        self.ngram_size = ngram_size
+        self.max_repeats = max_repeats
+        self.base_tokens = base_tokens
+        self.tokens_per_megapixel = tokens_per_megapixel
+        self.timeout = timeout
+
+    def token_budget(self, image_size: Tuple[int, int]) -> int:
+        """
+        Returns the token budget for an image of the given (width, height), as larger images can contain more text.
+        """
+        width, height = image_size
+        return int(self.base_tokens + self.tokens_per_megapixel * width * height / 1e6)
+
+    def create(
+        self, prompt_length: int, image_size: Tuple[int, int], max_new_tokens: int
+    ) -> StoppingCriteriaList:
+        """
+        Creates fresh stopping criteria for one generation.
+
+        Parameters
+        ----------
+        prompt_length : int
+            The number of prompt tokens, including image tokens.
+        image_size : Tuple[int, int]
+            The (width, height) of the image.
+        max_new_tokens : int
+            The max_new_tokens of the generation. The token budget criterion is only added when it is lower.
+
+        Returns
+        -------
+        StoppingCriteriaList
+            The stopping criteria to pass to generate.
+        """
+        criteria: List[RecordingStoppingCriteria] = []
+        if self.ngram_size is not None:
+            criteria.append(
+                NGramRepetitionCriteria(prompt_length, self.ngram_size, self.max_repeats)
+            )
+        if self.tokens_per_megapixel is not None:
+            budget = self.token_budget(image_size)
+            if budget < max_new_tokens:
+                criteria.append(TokenBudgetCriteria(prompt_length, budget))
+        if self.timeout is not None:
+            criteria.append(WallClockCriteria(prompt_length, self.timeout))
+        return StoppingCriteriaList(criteria)
+
+
+def summarize_stopping(
+    criteria: StoppingCriteriaList, max_new_tokens: int, eos_token_id: Optional[int] = None
+) -> Dict[str, object]:
+    """
+    Summarizes why a generation stopped.
+
+    Parameters
+    ----------
+    criteria : StoppingCriteriaList
+        The criteria created by DegenerationGuard.create, after the generation finished.
+    max_new_tokens : int
+        The max_new_tokens of the generation.
+    eos_token_id : int, optional
+        The end-of-sequence token, to tell a generation that ended exactly at max_new_tokens from one that
+        was cut off there (default is None, a generation reaching max_new_tokens counts as cut off).
+
+    Returns
+    -------
+    Dict[str, object]
+        new_tokens, truncated, stop_reason (None when the generation ended at EOS, "length" when it ran into
+        max_new_tokens) and tokens_saved compared to running until max_new_tokens.
+    """
+    new_tokens = max((criterion.new_tokens for criterion in criteria), default=0)
+    triggered = [criterion for criterion in criteria if criterion.triggered]
+    if triggered:
+        stop_reason = triggered[0].reason
+    elif new_tokens >= max_new_tokens and (
+        eos_token_id is None or any(criterion.last_token != eos_token_id for criterion in criteria)
+    ):
+        stop_reason = "length"
+    else:
+        stop_reason = None
+    return {
+        "new_tokens": new_tokens,
+        "truncated": stop_reason is not None,
+        "stop_reason": stop_reason,
+        "tokens_saved": max_new_tokens - new_tokens if triggered else 0,
+    }
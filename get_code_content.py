@@ -1,11 +1,25 @@
 import os
 import re
-from collections import Counter
-from typing import Generator, Tuple, List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Generator, Tuple, List, Optional
 import pandas as pd
+from code_index import CodeIndex
+from code_graph import rank_code_graph, score_units_by_centrality
+from code_selection import build_units, render_units, select_units
+from code_symbols import extract_symbol_tables, module_name, render_skeleton
+from tracing import span, traced
 
 
-def extract_docs_type_hints_and_contents_of(code: str, separator: str) -> str:
+def approximate_token_count(text: str) -> int:
+    """
+    Approximates the number of tokens in a text as one token per 4 characters,
+    which avoids running a tokenizer over complete packages.
+    """
+    return (len(text) + 3) // 4
+
+
+def _extract_with_regex(code: str) -> str:
     # Extract docstrings
     docstring_pattern = re.compile(r"\"\"\"[\s\S]*?\"\"\"")
     docstrings = docstring_pattern.findall(code)
@@ -18,15 +32,152 @@ def extract_docs_type_hints_and_contents_of(code: str, separator: str) -> str:
     class_pattern = re.compile(r"(class\s+\w+\s*\([^)]*\)\s*:)")
     classes = class_pattern.findall(code)
 
-    # Extract lines starting with "==================== CONTENTS OF:"
-    contents_of_pattern = re.compile(rf"(^.*?{separator}.*?$)", re.MULTILINE)
-    contents_of_lines = contents_of_pattern.findall(code)
+    return "\n".join(docstrings + signatures + classes)
+
+
+def extract_docs_type_hints_and_contents_of(
+    code: str,
+    separator: str,
+    content_separator: str = " CONTENTS OF: ",
+    max_workers: Optional[int] = 1,
+) -> str:
+    """
+    Extract the skeleton (signatures with type hints, decorators and docstrings) of every file in a
+    code content string, keeping the "CONTENTS OF" line of every file.
+    Files are parsed with ast; files that can no longer be parsed, e.g. after removing functions,
+    fall back to regex extraction.
+
+    Parameters
+    ----------
+    code : str
+        The code content as created by CodeContentOrganizer.get_code_content.
+    separator : str
+        The separator string used in the code content.
+    content_separator : str, optional
+        The text between the separators of a file header (default is " CONTENTS OF: ").
+    max_workers : int, optional
+        The number of processes parsing files (default is 1, parsing in this process).
+
+    Returns
+    -------
+    str
+        The skeleton of the code content.
+    """
+    header_pattern = re.compile(
+        rf"^{re.escape(separator)}{re.escape(content_separator)}(.*) {re.escape(separator)}$",
+        flags=re.MULTILINE,
+    )
+    headers = list(header_pattern.finditer(code))
+    sources = [
+        code[header.end() + 1 : headers[index + 1].start() if index + 1 < len(headers) else len(code)]
+        for index, header in enumerate(headers)
+    ]
+    tables = extract_symbol_tables(
+        [(header.group(1), source, "") for header, source in zip(headers, sources)],
+        max_workers,
+    )
+
+    parts = []
+    for header, source, table in zip(headers, sources, tables):
+        parts.append(header.group(0))
+        if table["error"] is None:
+            parts.append(render_skeleton([table], header=None))
+        else:
+            parts.append(_extract_with_regex(source))
+    return "\n".join(parts)
+
+
+def read_file(file_path: str) -> Tuple[str, str]:
+    """
+    Reads a file, returning its path and content or an error message as content.
+    """
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return file_path, f.read()
+    except Exception as e:
+        return file_path, f"Could not read file {file_path}: {e}"
+
+
+def read_file_or_none(file_path: str) -> Tuple[str, Optional[str]]:
+    """
+    Reads a file, returning its path and content or None as content, for callers that must not mistake
+    an error message for the content, like the index.
+    """
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return file_path, f.read()
+    except Exception:
+        return file_path, None
+
+
+def compile_substring_pattern(substrings: List[str]) -> Optional[re.Pattern]:
+    """
+    Compiles substrings into a single regex, so a path is checked against all of them in one search.
+    Returns None when there are no substrings.
+    """
+    if not substrings:
+        return None
+    return re.compile("|".join(re.escape(substring) for substring in substrings))
+
+
+def _glob_to_regex(pattern: str) -> str:
+    regex = ""
+    index = 0
+    while index < len(pattern):
+        if pattern.startswith("**/", index):
+            regex += "(?:.*/)?"
+            index += 3
+        elif pattern.startswith("**", index):
+            regex += ".*"
+            index += 2
+        elif pattern[index] == "*":
+            regex += "[^/]*"
+            index += 1
+        elif pattern[index] == "?":
+            regex += "[^/]"
+            index += 1
+        else:
+            regex += re.escape(pattern[index])
+            index += 1
+    return regex
+
+
+def compile_gitignore_patterns(
+    patterns: List[str],
+) -> Tuple[Optional[re.Pattern], Optional[re.Pattern]]:
+    """
+    Compiles gitignore-style patterns into two regexes matched against paths relative to the root,
+    with "/" as separator. Supports "*", "?", "**", a leading "/" to anchor at the root and a trailing "/"
+    for directories only. Comments and empty lines are skipped; negations ("!") are not supported and skipped.
 
-    # Combine all extracted parts
-    extracted_parts = docstrings + signatures + classes + contents_of_lines
-    result = "\n".join(extracted_parts)
+    Parameters
+    ----------
+    patterns : list of str
+        The gitignore-style patterns.
 
-    return result
+    Returns
+    -------
+    tuple of (re.Pattern or None, re.Pattern or None)
+        The regex for patterns matching files and directories, and the regex for directory-only patterns.
+    """
+    any_regexes = []
+    dir_regexes = []
+    for pattern in patterns:
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith(("#", "!")):
+            continue
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        # as in git, a pattern with a slash (other than a trailing one) is relative to the root
+        anchored = "/" in pattern
+        regex = _glob_to_regex(pattern.lstrip("/"))
+        regex = regex if anchored else f"(?:.*/)?{regex}"
+        (dir_regexes if dir_only else any_regexes).append(regex)
+
+    def combine(regexes: List[str]) -> Optional[re.Pattern]:
+        return re.compile("(?:" + "|".join(regexes) + ")$") if regexes else None
+
+    return combine(any_regexes), combine(dir_regexes)
 
 
 class CodeContentOrganizer:
@@ -43,6 +194,15 @@ class CodeContentOrganizer:
         Directories to exclude from processing (default is None).
     exclude_files : list of str, optional
         Files to exclude from processing (default is None).
+    ignore_patterns : list of str, optional
+        Gitignore-style patterns of files and directories to exclude (default is None).
+    use_gitignore : bool, optional
+        Also exclude the patterns in the .gitignore file of root_dir, if present (default is False).
+    read_workers : int, optional
+        The number of threads reading files concurrently (default is 8).
+    index_path : str, optional
+        A SQLite file in which contents, symbol tables, token counts and imports are kept between runs.
+        Only files whose mtime or size changed are re-read and re-parsed (default is None, no index).
     """
 
     def __init__(
@@ -50,219 +210,478 @@ class CodeContentOrganizer:
         root_dir: str,
         exclude_dirs: List[str] = ["__pycache__"],
         exclude_files: List[str] = ["test"],
+        ignore_patterns: Optional[List[str]] = None,
+        use_gitignore: bool = False,
+        read_workers: int = 8,
+        index_path: Optional[str] = None,
     ):
         self.root_dir = root_dir
         self.exclude_dirs = exclude_dirs if exclude_dirs is not None else []
         self.exclude_files = exclude_files if exclude_files is not None else []
         self.separator = "===================="
         self.content_separator = " CONTENTS OF: "
+        self.bundle_stats = {}
+        self.read_workers = read_workers
+        self.index = (
+            CodeIndex(index_path) if index_path is not None else None
+        )
+        self.index_stats = {}
+
+        self._exclude_dirs_pattern = compile_substring_pattern(self.exclude_dirs)
+        self._exclude_files_pattern = compile_substring_pattern(self.exclude_files)
+        patterns = list(ignore_patterns or [])
+        gitignore_path = os.path.join(root_dir, ".gitignore")
+        if use_gitignore and os.path.isfile(gitignore_path):
+            with open(gitignore_path, "r", encoding="utf-8") as f:
+                patterns += f.read().splitlines()
+        self._ignore_pattern, self._ignore_dirs_pattern = compile_gitignore_patterns(patterns)
+
+    def _is_ignored(self, relative_path: str, is_dir: bool) -> bool:
+        if self._ignore_pattern is not None and self._ignore_pattern.match(relative_path):
+            return True
+        return (
+            is_dir
+            and self._ignore_dirs_pattern is not None
+            and self._ignore_dirs_pattern.match(relative_path) is not None
+        )
 
-    def generate_directory_tree(self) -> Generator[str, None, None]:
+    @traced("code.scan")
+    def scan(self) -> Tuple[List[str], List[str]]:
         """
-        Generate a directory tree structure starting from the root directory.
+        Walk the directory tree once with os.scandir, producing both the directory tree and the file list.
+        Symbolic links are skipped, so a link cycle can not make the walk recurse forever.
 
-        Yields
-        ------
-        str
-            A line representing a part of the directory tree.
+        Returns
+        -------
+        tuple of (list of str, list of str)
+            The lines of the directory tree (without the root line) and the paths of the
+            Python files, in the same order as in the tree.
         """
-
-        def walk_dir(current_dir: str, prefix: str = "") -> Generator[str, None, None]:
-            contents = sorted(os.listdir(current_dir))
-            files = [
-                f
-                for f in contents
-                if os.path.isfile(os.path.join(current_dir, f))
-                and f.endswith(".py")
-                and not any(
-                    exclude in os.path.join(current_dir, f)
-                    for exclude in self.exclude_files
-                )
-            ]
-            dirs = [
-                d
-                for d in contents
-                if os.path.isdir(os.path.join(current_dir, d))
-                and not any(
-                    exclude in os.path.join(current_dir, d)
-                    for exclude in self.exclude_dirs
-                )
-            ]
-
-            for index, file in enumerate(files):
+        tree_lines = []
+        file_paths = []
+
+        def walk_dir(current_dir: str, relative_dir: str, prefix: str) -> None:
+            with os.scandir(current_dir) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+            files = []
+            dirs = []
+            for entry in entries:
+                relative_path = f"{relative_dir}{entry.name}"
+                if entry.is_file(follow_symlinks=False):
+                    if not (
+                        entry.name.endswith(".py")
+                        and not (
+                            self._exclude_files_pattern is not None
+                            and self._exclude_files_pattern.search(entry.path)
+                        )
+                        and not self._is_ignored(relative_path, False)
+                    ):
+                        continue
+                    files.append(entry)
+                elif entry.is_dir(follow_symlinks=False):
+                    if (
+                        self._exclude_dirs_pattern is not None
+                        and self._exclude_dirs_pattern.search(entry.path)
+                    ) or self._is_ignored(relative_path, True):
+                        continue
+                    dirs.append(entry)
+
+            for index, entry in enumerate(files):
                 if index == len(files) - 1 and not dirs:
-                    yield f"{prefix}└── {file}"
+                    tree_lines.append(f"{prefix}└── {entry.name}")
                 else:
-                    yield f"{prefix}├── {file}"
+                    tree_lines.append(f"{prefix}├── {entry.name}")
+                file_paths.append(entry.path)
 
-            for index, directory in enumerate(dirs):
+            for index, entry in enumerate(dirs):
                 if index == len(dirs) - 1:
-                    yield f"{prefix}└── {directory}"
-                    yield from walk_dir(
-                        os.path.join(current_dir, directory), prefix + "    "
-                    )
+                    tree_lines.append(f"{prefix}└── {entry.name}")
+                    walk_dir(entry.path, f"{relative_dir}{entry.name}/", prefix + "    ")
                 else:
-                    yield f"{prefix}├── {directory}"
-                    yield from walk_dir(
-                        os.path.join(current_dir, directory), prefix + "│   "
-                    )
+                    tree_lines.append(f"{prefix}├── {entry.name}")
+                    walk_dir(entry.path, f"{relative_dir}{entry.name}/", prefix + "│   ")
+
+        walk_dir(self.root_dir, "", "")
+        return tree_lines, file_paths
+
+    def generate_directory_tree(
+        self, tree_lines: Optional[List[str]] = None
+    ) -> Generator[str, None, None]:
+        """
+        Generate a directory tree structure starting from the root directory.
 
+        Parameters
+        ----------
+        tree_lines : list of str, optional
+            The tree lines of a previous scan (default is None, scanning the directory tree).
+
+        Yields
+        ------
+        str
+            A line representing a part of the directory tree.
+        """
         yield f"{os.path.abspath(self.root_dir)}"
-        yield from walk_dir(self.root_dir)
+        yield from tree_lines if tree_lines is not None else self.scan()[0]
 
-    def generate_file_contents(self) -> Generator[Tuple[str, str], None, None]:
+    def generate_file_contents(
+        self, file_paths: Optional[List[str]] = None
+    ) -> Generator[Tuple[str, str], None, None]:
         """
         Generate the contents of Python files in the directory tree.
+        With an index, unchanged files come from the index. Otherwise files are read ahead on a thread pool,
+        with a bounded number of files in flight to keep memory flat.
+
+        Parameters
+        ----------
+        file_paths : list of str, optional
+            The file paths of a previous scan (default is None, scanning the directory tree).
 
         Yields
         ------
         tuple of (str, str)
             The file path and its content.
         """
-        for root, dirs, files in os.walk(self.root_dir):
-            dirs[:] = [
-                d
-                for d in dirs
-                if not any(
-                    exclude in os.path.join(root, d) for exclude in self.exclude_dirs
-                )
-            ]
-            for file in files:
-                if file.endswith(".py") and not any(
-                    exclude in os.path.join(root, file)
-                    for exclude in self.exclude_files
-                ):
-                    file_path = os.path.join(root, file)
-                    try:
-                        with open(file_path, "r", encoding="utf-8") as f:
-                            content = f.read()
-                        yield file_path, content
-                    except Exception as e:
-                        yield file_path, f"Could not read file {file_path}: {e}"
-
-    def get_code_content(self) -> str:
+        file_paths = file_paths if file_paths is not None else self.scan()[1]
+        if self.index is not None:
+            self.refresh_index(file_paths)
+            yield from self.index.contents(file_paths)
+        else:
+            yield from self._read_files(file_paths)
+
+    def _read_files(
+        self, file_paths: List[str], reader: Callable[[str], Tuple[str, Optional[str]]] = read_file
+    ) -> Generator[Tuple[str, Optional[str]], None, None]:
+        with ThreadPoolExecutor(max_workers=self.read_workers) as executor:
+            pending = deque()
+            for file_path in file_paths:
+                pending.append(executor.submit(reader, file_path))
+                if len(pending) >= 4 * self.read_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    @traced("code.refresh_index")
+    def refresh_index(self, file_paths: Optional[List[str]] = None) -> Dict[str, float]:
         """
-        Get the code content from the directory tree.
+        Re-process the files that changed since the last run into the index.
+        The statistics of the refresh are kept in self.index_stats.
+
+        Parameters
+        ----------
+        file_paths : list of str, optional
+            The file paths of a previous scan (default is None, scanning the directory tree).
+
+        Returns
+        -------
+        dict
+            The number of files, re-parsed, touched, unreadable and removed files and the seconds it took.
+        """
+        if self.index is None:
+            raise ValueError("CodeContentOrganizer was created without index_path.")
+        file_paths = file_paths if file_paths is not None else self.scan()[1]
+        # a read error is not stored, so the file is read again on the next refresh
+        self.index_stats = self.index.refresh(
+            self.root_dir, file_paths, lambda paths: self._read_files(paths, read_file_or_none)
+        )
+        return self.index_stats
+
+    @traced("code.symbol_tables")
+    def get_symbol_tables(
+        self, max_workers: Optional[int] = None, file_paths: Optional[List[str]] = None
+    ) -> List[Dict]:
+        """
+        Get the symbol tables of all Python files in the directory tree, parsed in parallel.
+        With an index, only changed files are parsed.
+
+        Parameters
+        ----------
+        max_workers : int, optional
+            The number of processes parsing files (default is None, the number of CPUs).
+        file_paths : list of str, optional
+            The file paths of a previous scan (default is None, scanning the directory tree).
+
+        Returns
+        -------
+        list of dict
+            The symbol table of every file, see code_symbols.extract_symbols.
+        """
+        file_paths = file_paths if file_paths is not None else self.scan()[1]
+        if self.index is not None:
+            self.refresh_index(file_paths)
+            return self.index.symbol_tables(file_paths)
+        files = (
+            (file_path, file_content, module_name(file_path, self.root_dir))
+            for file_path, file_content in self._read_files(file_paths)
+        )
+        return extract_symbol_tables(files, max_workers)
+
+    def get_code_skeleton(
+        self, max_workers: Optional[int] = None, max_docstring_lines: Optional[int] = None
+    ) -> str:
+        """
+        Get the directory tree and the skeleton of all code: signatures with type hints, decorators and
+        docstrings, without implementations. A compact alternative to get_code_content for large packages.
+
+        Parameters
+        ----------
+        max_workers : int, optional
+            The number of processes parsing files (default is None, the number of CPUs).
+        max_docstring_lines : int, optional
+            Truncate docstrings to this number of lines (default is None, full docstrings).
 
         Returns
         -------
         str
-            The formatted code content.
+            The formatted code skeleton.
         """
+        tree_lines, file_paths = self.scan()
+        tables = self.get_symbol_tables(max_workers, file_paths)
+
         content = f"{self.separator} DIRECTORY TREE STRUCTURE {self.separator}\n"
-        content += "\n".join(self.generate_directory_tree())
+        content += "\n".join(self.generate_directory_tree(tree_lines))
+        content += f"\n\n{self.separator} CODE SKELETON {self.separator}\n"
+        content += render_skeleton(
+            tables,
+            header=f"{self.separator}{self.content_separator}{{path}} {self.separator}",
+            max_docstring_lines=max_docstring_lines,
+        )
+        return content
 
-        content += f"\n\n{self.separator} CODE CONTENT {self.separator}\n"
-        file_contents = self.generate_file_contents()
-        for file_path, file_content in file_contents:
-            content += f"\n{self.separator}{self.content_separator}{file_path} {self.separator}\n"
-            content += file_content
+    def iter_code_content(
+        self,
+        max_tokens: Optional[int] = None,
+        count_tokens: Callable[[str], int] = approximate_token_count,
+    ) -> Generator[str, None, None]:
+        """
+        Stream the code content from the directory tree in chunks, reading one file at a time.
+        The number of bytes, tokens and files emitted so far is kept in self.bundle_stats.
 
-        return content
+        Parameters
+        ----------
+        max_tokens : int, optional
+            Stop before the first chunk that would exceed this token budget (default is None, no budget).
+        count_tokens : Callable[[str], int], optional
+            Counts the tokens of a chunk (default is approximate_token_count).
+            For exact counts pass e.g. lambda text: len(tokenizer.tokenize(text)).
+
+        Yields
+        ------
+        str
+            A chunk of the formatted code content: the tree header, a tree line or a complete file.
+        """
+        self.bundle_stats = {"bytes": 0, "tokens": 0, "files": 0, "truncated": False}
+
+        tree_lines, file_paths = self.scan()
+
+        def chunks() -> Generator[Tuple[str, bool], None, None]:
+            yield f"{self.separator} DIRECTORY TREE STRUCTURE {self.separator}\n", False
+            for index, line in enumerate(self.generate_directory_tree(tree_lines)):
+                yield line if index == 0 else f"\n{line}", False
+            yield f"\n\n{self.separator} CODE CONTENT {self.separator}\n", False
+            for file_path, file_content in self.generate_file_contents(file_paths):
+                header = f"\n{self.separator}{self.content_separator}{file_path} {self.separator}\n"
+                yield header + file_content, True
+
+        for chunk, is_file in chunks():
+            tokens = count_tokens(chunk)
+            if max_tokens is not None and self.bundle_stats["tokens"] + tokens > max_tokens:
+                self.bundle_stats["truncated"] = True
+                break
+            self.bundle_stats["bytes"] += len(chunk.encode("utf-8"))
+            self.bundle_stats["tokens"] += tokens
+            self.bundle_stats["files"] += is_file
+            yield chunk
+
+    def write_code_content(
+        self,
+        path: str,
+        max_tokens: Optional[int] = None,
+        count_tokens: Callable[[str], int] = approximate_token_count,
+    ) -> Dict[str, int]:
+        """
+        Write the code content to a file, without holding the complete content in memory.
+
+        Parameters
+        ----------
+        path : str
+            The output file.
+        max_tokens : int, optional
+            The token budget of the content (default is None, no budget).
+        count_tokens : Callable[[str], int], optional
+            Counts the tokens of a chunk (default is approximate_token_count).
 
-    def optimize_content_length(
-        self, content: str, max_lines: int, top_p_start=0.5, increments=0.01
+        Returns
+        -------
+        Dict[str, int]
+            The bytes, tokens and files written and whether the budget truncated the content.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            for chunk in self.iter_code_content(max_tokens, count_tokens):
+                f.write(chunk)
+        return self.bundle_stats
+
+    @traced("code.get_code_content")
+    def get_code_content(
+        self,
+        max_tokens: Optional[int] = None,
+        count_tokens: Callable[[str], int] = approximate_token_count,
     ) -> str:
         """
-        Optimize the code content length by filtering less relevant functions.
+        Get the code content from the directory tree.
 
         Parameters
         ----------
-        content : str
-            The original code content.
-        max_lines : int
-            The maximum number of lines for the optimized content.
+        max_tokens : int, optional
+            The token budget of the content (default is None, no budget).
+        count_tokens : Callable[[str], int], optional
+            Counts the tokens of a chunk (default is approximate_token_count).
 
         Returns
         -------
         str
-            The optimized code content.
+            The formatted code content.
         """
-        lines = content.split("\n")
-        if len(lines) <= max_lines:
-            return content
-
-        ranking = self._rank_internal_modules(content)
-        top_p = top_p_start
+        return "".join(self.iter_code_content(max_tokens, count_tokens))
 
-        while len(lines) > max_lines and top_p > 0:
-            top_index = int(len(ranking) * top_p)
-            modules_to_remove = ranking.iloc[top_index:].index.tolist()
-            content = self._remove_modules_by_name(
-                content, modules_to_remove, self.separator
-            )
-            lines = content.split("\n")
-            top_p -= increments
+    def _split_content(self, content: str) -> Tuple[str, List[str], List[str], List[str]]:
+        """
+        Split code content into the part before the first file (the directory tree) and one segment per file.
 
-        return content
+        Returns
+        -------
+        tuple of (str, list of str, list of str, list of str)
+            The prefix, and the path, segment (header included) and source of every file.
+        """
+        header_pattern = re.compile(
+            rf"^\n?{re.escape(self.separator)}{re.escape(self.content_separator)}(.*) {re.escape(self.separator)}$",
+            flags=re.MULTILINE,
+        )
+        headers = list(header_pattern.finditer(content))
+        end = headers[0].start() if headers else len(content)
+        segments = [
+            content[header.start() : headers[index + 1].start() if index + 1 < len(headers) else len(content)]
+            for index, header in enumerate(headers)
+        ]
+        sources = [
+            segment[header.end() - header.start() + 1 :]
+            for header, segment in zip(headers, segments)
+        ]
+        return content[:end], [header.group(1) for header in headers], segments, sources
+
+    def _content_tables(self, content: str) -> List[Dict]:
+        _, paths, _, sources = self._split_content(content)
+        return extract_symbol_tables(
+            [
+                (path, source, module_name(path, self.root_dir))
+                for path, source in zip(paths, sources)
+            ],
+            max_workers=1,
+        )
 
-    def _rank_internal_modules(self, content: str) -> pd.Series:
+    @traced("code.optimize_content_length")
+    def optimize_content_length(self, content: str, max_lines: int) -> str:
         """
-        Rank internal modules based on their usage within the package.
+        Optimize the code content length by dropping the least relevant modules.
+        Modules are ranked once by their centrality in the import and call graph and selected in a single
+        pass by relevance per line, see code_selection.select_units.
 
         Parameters
         ----------
         content : str
             The original code content.
+        max_lines : int
+            The maximum number of lines for the optimized content.
 
         Returns
         -------
-        pd.Series
-            A Series containing the ranking of each internal module.
+        str
+            The optimized code content.
         """
-        module_imports = re.findall(
-            r"^\s*from\s+(\.\w+)\s+import|^\s*import\s+(\.\w+)",
-            content,
-            flags=re.MULTILINE,
-        )
-        flattened_imports = [
-            item for sublist in module_imports for item in sublist if item
+        if content.count("\n") < max_lines:
+            return content
+
+        prefix, paths, segments, _ = self._split_content(content)
+        if not segments:
+            return content
+
+        ranking = self._rank_internal_modules(content)
+        units = [
+            {"cost": segment.count("\n"), "requires": None} for segment in segments
         ]
-        import_counts = Counter(flattened_imports)
-        return pd.Series(import_counts).sort_values(ascending=False)
+        scores = [ranking.get(module_name(path, self.root_dir), 0.0) for path in paths]
+        selected = select_units(units, scores, max_lines - prefix.count("\n") - 1)
+        return prefix + "".join(segments[index] for index in selected)
 
-    def _remove_modules_by_name(
-        self, code: str, module_names: List[str], separator: str
+    @traced("code.get_budgeted_content")
+    def get_budgeted_content(
+        self,
+        max_tokens: int,
+        count_tokens: Callable[[str], int] = approximate_token_count,
+        scores: Optional[Callable[[List[Dict], List[Dict]], List[float]]] = None,
     ) -> str:
         """
-        Removes modules from the codecontent-string based on their names.
+        Get the code content that fits a token budget, choosing individual classes and functions instead of
+        whole modules. Every file header (imports, constants) and top-level class or function is a unit with a
+        known token cost; units are scored once and the best-value subset is selected in a single pass.
 
         Parameters
         ----------
-        code : str
-            The original code as a string.
-        module_names : list of str
-            The names of the modules to be removed.
-        separator : str
-            The separator string used in the code content.
+        max_tokens : int
+            The token budget of the content, including the directory tree.
+        count_tokens : Callable[[str], int], optional
+            Counts the tokens of a unit (default is approximate_token_count).
+        scores : Callable[[List[Dict], List[Dict]], List[float]], optional
+            Scores the units given the units and symbol tables
+            (default is code_graph.score_units_by_centrality).
 
         Returns
         -------
         str
-            The code with the specified modules removed.
+            The formatted code content of the selected units.
         """
-        # Create a regex pattern to match the content blocks for the specified modules
-        module_patterns = [
-            re.escape(separator)
-            + rf"{self.content_separator}.*"
-            + re.escape(module.replace(".", os.sep))
-            + r"\.py "
-            + re.escape(separator)
-            + r"[\s\S]*?(?="
-            + re.escape(separator)
-            + rf"{self.content_separator}|\Z)"
-            for module in module_names
+        tree_lines, file_paths = self.scan()
+        tables = [
+            table
+            for table in self.get_symbol_tables(file_paths=file_paths)
+            if table["error"] is None
         ]
-        module_pattern = "|".join(module_patterns)
+        with span("code.read_contents"):
+            contents = dict(self.generate_file_contents([table["path"] for table in tables]))
+        with span("code.build_units"):
+            units = build_units(tables, contents, count_tokens)
+        with span("code.score_units"):
+            unit_scores = (scores or score_units_by_centrality)(units, tables)
 
-        # Use re.sub to remove the matched blocks
-        code = re.sub(module_pattern, "", code, flags=re.MULTILINE)
+        content = f"{self.separator} DIRECTORY TREE STRUCTURE {self.separator}\n"
+        content += "\n".join(self.generate_directory_tree(tree_lines))
+        content += f"\n\n{self.separator} CODE CONTENT {self.separator}\n"
+        header = f"{self.separator}{self.content_separator}{{path}} {self.separator}"
+        # every file header line is counted as part of the budget, up front
+        budget = max_tokens - count_tokens(content) - len(tables) * count_tokens(header)
+        selected = select_units(units, unit_scores, budget)
+        return content + render_units(units, selected, header)
 
-        return code
+    def _rank_internal_modules(self, content: str) -> pd.Series:
+        """
+        Rank internal modules based on their centrality in the import and call graph of the package.
+
+        Parameters
+        ----------
+        content : str
+            The original code content.
+
+        Returns
+        -------
+        pd.Series
+            A Series containing the ranking of each internal module, indexed by dotted module name.
+        """
+        ranks = rank_code_graph(self._content_tables(content))
+        return ranks[~ranks.index.str.contains(":", regex=False)]
 
     def _rank_internal_functions(self, content: str) -> pd.Series:
         """
-        Rank internal functions based on their usage within the package.
+        Rank internal classes, functions and methods based on their centrality in the import and
+        call graph of the package.
 
         Parameters
         ----------
@@ -272,16 +691,10 @@ class CodeContentOrganizer:
         Returns
         -------
         pd.Series
-            A Series containing the count of each function.
+            A Series containing the ranking of each symbol, indexed by "module:qualname".
         """
-        lines = content.split("\n")
-        func_counts = dict()
-        all_funcs = set(f"{i[4:].split('(')[0]}" for i in lines if i.startswith("def "))
-        for func in all_funcs:
-            c = content.count(func)
-            func_counts[func] = c
-        func_counts = pd.Series(func_counts).sort_values(ascending=False)
-        return func_counts
+        ranks = rank_code_graph(self._content_tables(content))
+        return ranks[ranks.index.str.contains(":", regex=False)]
 
     def _remove_functions_by_name(self, code: str, func_names: List[str]) -> str:
         """
@@ -314,6 +727,12 @@ if __name__ == "__main__":
     root_dir = r".venv\Lib\site-packages\accelerate"
 
     organizer = CodeContentOrganizer(root_dir)
+    bundle_stats = organizer.write_code_content("code_content.txt", max_tokens=100000)
+    print(
+        f"Wrote {bundle_stats['files']} files, {bundle_stats['bytes']} bytes, "
+        f"~{bundle_stats['tokens']} tokens (truncated: {bundle_stats['truncated']})"
+    )
+
     content = organizer.get_code_content()
     optimized_content = organizer.optimize_content_length(content, 5000)
     optimized_content = extract_docs_type_hints_and_contents_of(optimized_content, organizer.separator)
@@ -0,0 +1,148 @@
+# llm_coalescing.py
+
+import hashlib
+import json
+import threading
+from typing import Dict, Generator, List, Optional
+import numpy as np
+from llm_invoke import LLM
+
+
+class _Flight:
+    def __init__(self):
+        self.pieces: List[str] = []
+        self.done = False
+        self.cancelled = False
+        self.error: Optional[BaseException] = None
+        self.condition = threading.Condition()
+
+
+class CoalescingLLM:
+    def __init__(self, llm: LLM, backend=None):
+        """
+        Runs identical in-flight requests as a single generation. Requests are identical when their prompts
+        tokenize to the same tokens after context management and their generation arguments are equal;
+        only deterministic requests (temperature 0) are coalesced, sampled ones always run on their own.
+        Every subscriber receives the full token stream: one that joins late first gets the pieces
+        produced so far, then follows the live generation.
+
+        Parameters
+        ----------
+        llm : LLM
+            The model, used for the prompt and tokenizer.
+        backend : optional
+            What runs the generations, anything with the stream method of LLM, e.g. a BatchScheduler
+            (default is None, llm itself). A plain LLM has a single KV cache, so its generations
+            run one at a time; use a BatchScheduler to run distinct requests concurrently.
+        """
+        self.llm = llm
+        self.backend = backend if backend is not None else llm
+        # llama_cpp.Llama is not thread-safe: one KV cache, one input_ids and one last_stats
+        self.backend_lock = threading.Lock() if isinstance(self.backend, LLM) else None
+        self.flights: Dict[str, _Flight] = {}
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "generations": 0, "coalesced": 0}
+
+    def request_key(self, messages: List[Dict[str, str]], **kwargs) -> Optional[str]:
+        """
+        Returns the key identifying a request, or None if the request is not deterministic.
+        """
+        if kwargs.get("temperature", 0.8) > 0 and kwargs.get("top_k") != 1:
+            return None
+        prompt = self.llm._strip_bos_token(self.llm.ctx(messages))
+        tokens = np.asarray(
+            self.llm.llm.tokenize(prompt.encode("utf-8"), add_bos=True, special=True), dtype=np.int32
+        )
+        digest = hashlib.sha1(tokens.tobytes())
+        digest.update(json.dumps(kwargs, sort_keys=True, default=repr).encode("utf-8"))
+        return digest.hexdigest()
+
+    def stream(self, messages: List[Dict[str, str]], **kwargs) -> Generator[str, None, None]:
+        """
+        Streams the output for the input messages like LLM.stream, sharing the generation with identical
+        requests in flight.
+
+        Parameters
+        ----------
+        messages : List[Dict[str, str]]
+            A list of messages to be processed by the LLM.
+        **kwargs
+            Additional keyword arguments for the LLM.
+
+        Yields
+        ------
+        str
+            Parts of the generated text by the LLM.
+        """
+        key = self.request_key(messages, **kwargs)
+        start = False
+        with self.lock:
+            self.stats["requests"] += 1
+            if key is None:
+                flight = _Flight()
+                start = True
+            elif key in self.flights:
+                flight = self.flights[key]
+                self.stats["coalesced"] += 1
+            else:
+                flight = self.flights[key] = _Flight()
+                start = True
+            if start:
+                self.stats["generations"] += 1
+        if start:
+            # every generation runs in its own thread, so the backend lock is never held across a yield
+            # to a subscriber; a shared generation outlives a subscriber that stops reading
+            threading.Thread(
+                target=self._generate, args=(key, flight, messages, kwargs), daemon=True
+            ).start()
+
+        index = 0
+        try:
+            while True:
+                with flight.condition:
+                    while index >= len(flight.pieces) and not flight.done:
+                        flight.condition.wait()
+                    pieces = flight.pieces[index:]
+                    done = flight.done
+                index += len(pieces)
+                # a late joiner gets all pieces so far at once, as a replay
+                yield from pieces
+                if done and index >= len(flight.pieces):
+                    break
+        finally:
+            # nobody else reads a private generation, so it stops once its only subscriber is gone
+            if key is None:
+                flight.cancelled = True
+        if flight.error is not None:
+            raise flight.error
+
+    def _backend_stream(self, messages: List[Dict[str, str]], kwargs: Dict) -> Generator[str, None, None]:
+        if self.backend_lock is None:
+            yield from self.backend.stream(messages, **kwargs)
+            return
+        with self.backend_lock:
+            yield from self.backend.stream(messages, **kwargs)
+
+    def _generate(
+        self, key: Optional[str], flight: _Flight, messages: List[Dict[str, str]], kwargs: Dict
+    ) -> None:
+        stream = self._backend_stream(messages, kwargs)
+        try:
+            for piece in stream:
+                if flight.cancelled:
+                    break
+                with flight.condition:
+                    flight.pieces.append(piece)
+                    flight.condition.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            # closing the stream releases the backend lock right away, also after a cancel
+            stream.close()
+            # no new subscribers after this point, a new identical request starts a new generation
+            if key is not None:
+                with self.lock:
+                    del self.flights[key]
+            with flight.condition:
+                flight.done = True
+                flight.condition.notify_all()
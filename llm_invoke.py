@@ -1,10 +1,20 @@
 # llm_invoke.py
 
+import codecs
+import queue
+import threading
+import time
+import numpy as np
 import torch
+import llama_cpp
 from llama_cpp import Llama
+# low-level API of the pinned llama-cpp-python version, see requirements.txt
+from llama_cpp import _internals
 from ctx import ContextManagement
-from typing import List, Dict, Generator
+from typing import List, Dict, Generator, Optional
 from transformers import AutoTokenizer
+from speculative_decoding import create_draft_model
+from tracing import span
 
 
 class LLM:
@@ -23,21 +33,37 @@ class LLM:
         context_length : int, optional
             Maximum tokens available for context management (default is 2560).
         **kwargs
-            Additional keyword arguments for model configuration.
+            Additional keyword arguments for model configuration. Set speculative to "prompt_lookup" or
+            "draft_model" (with draft_model_path) to verify several drafted tokens per forward pass,
+            see speculative_decoding.create_draft_model for the other options.
         """
         self._validate_model(model_path)
 
         tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+        self.draft_model = None
+        if kwargs.get("speculative") is not None:
+            self.draft_model = create_draft_model(
+                kwargs["speculative"], context_length=context_length, **kwargs
+            )
         self.llm = Llama(
             model_path=model_path,
             n_gpu_layers=kwargs.get("n_gpu_layers", -1),
             seed=kwargs.get("seed", 1337),
             n_ctx=context_length,
             n_threads=kwargs.get("n_threads", 8),
+            draft_model=self.draft_model,
         )
         self.ctx = ContextManagement(tokenizer, context_length)
+        self.last_stats = {}
         self.check_gpu_availability()
 
+    def use_speculative(self, enabled: bool) -> None:
+        """
+        Switches speculative decoding on or off for the next generations, e.g. to compare against the plain path
+        on the same loaded model. Has no effect if the model was created without a speculative mode.
+        """
+        self.llm.draft_model = self.draft_model if enabled else None
+
     def check_gpu_availability(self) -> None:
         """
         Checks the availability of GPU and prints the result.
@@ -65,11 +91,25 @@ class LLM:
         str
             Parts of the generated text by the LLM.
         """
-        input_message = self.ctx(messages)
-        input_message = self._strip_bos_token(input_message)
+        with span("llm.context"):
+            input_message = self.ctx(messages)
+            input_message = self._strip_bos_token(input_message)
+        self._start_stats()
         output = self.llm(input_message, stream=True, echo=False, **kwargs)
-        for op in output:
-            yield op.get("choices")[0].get("text") or ""
+        parts = []
+        # the first token arrives after tokenization and prompt evaluation, the rest is decode;
+        # both spans include the time the consumer spends between tokens
+        with span("llama.prompt_eval"):
+            op = next(output, None)
+        with span("llama.decode"):
+            while op is not None:
+                part = op.get("choices")[0].get("text") or ""
+                parts.append(part)
+                yield part
+                op = next(output, None)
+        # a streamed chunk holds any number of tokens: several after a held back stop sequence or
+        # multi-byte character, none while held back, so the tokens are counted on the output itself
+        self._finish_stats(self._count_tokens("".join(parts)))
 
     def complete(self, messages: List[Dict[str, str]], **kwargs) -> str:
         """
@@ -87,11 +127,38 @@ class LLM:
         str
             The completed text generated by the LLM.
         """
-        input_message = self.ctx(messages)
-        input_message = self._strip_bos_token(input_message)
-        output = self.llm(input_message, echo=False, **kwargs)
+        with span("llm.context"):
+            input_message = self.ctx(messages)
+            input_message = self._strip_bos_token(input_message)
+        self._start_stats()
+        with span("llama.complete"):
+            output = self.llm(input_message, echo=False, **kwargs)
+        self._finish_stats(output.get("usage", {}).get("completion_tokens", 0))
         return output.get("choices")[0].get("text")
 
+    def _count_tokens(self, text: str) -> int:
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)) if text else 0
+
+    def _start_stats(self) -> None:
+        self.last_stats = {"start": time.time()}
+        if self.draft_model is not None:
+            self.draft_model.reset()
+
+    def _finish_stats(self, tokens: int) -> None:
+        """
+        Records the generated tokens, seconds and tokens per second of the last generation in last_stats,
+        with the acceptance rate of the drafted tokens when speculative decoding is on.
+        """
+        seconds = time.time() - self.last_stats.pop("start")
+        self.last_stats = {
+            "tokens": tokens,
+            "seconds": seconds,
+            "tokens_per_second": tokens / seconds if seconds > 0 else 0.0,
+            "speculative": self.llm.draft_model is not None,
+        }
+        if self.llm.draft_model is not None:
+            self.last_stats.update(self.draft_model.summary())
+
     def _strip_bos_token(self, text: str) -> str:
         """
         Strips the beginning-of-sequence (BOS) token from the input text.
@@ -116,3 +183,311 @@ class LLM:
             raise ValueError(
                 f"Invalid model file format: {model_path}. llama_cpp expects a local .gguf file."
             )
+
+
+class _Sequence:
+    def __init__(self, prompt_tokens: List[int], max_tokens: int, sampling: Dict, stop: List[str]):
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.sampling = sampling
+        self.stop = stop
+        self.output = queue.Queue()
+        self.cancelled = False
+        self.slot = None
+        self.position = 0
+        self.last_token = None
+        self.generated = 0
+        self.text = ""
+        self.emitted = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+
+def sample_token(logits: np.ndarray, temperature: float, top_k: int, top_p: float, rng: np.random.Generator) -> int:
+    """
+    Samples a token from the logits with temperature, top-k and top-p (nucleus) sampling,
+    or greedily when the temperature is 0.
+    """
+    if temperature <= 0:
+        return int(np.argmax(logits))
+    candidates = np.argpartition(-logits, top_k - 1)[:top_k] if 0 < top_k < len(logits) else np.arange(len(logits))
+    scaled = logits[candidates] / temperature
+    probabilities = np.exp(scaled - scaled.max())
+    probabilities /= probabilities.sum()
+    if top_p < 1.0:
+        order = np.argsort(-probabilities)
+        keep = order[: int(np.searchsorted(np.cumsum(probabilities[order]), top_p)) + 1]
+        candidates, probabilities = candidates[keep], probabilities[keep] / probabilities[keep].sum()
+    return int(rng.choice(candidates, p=probabilities))
+
+
+class BatchScheduler:
+    def __init__(
+        self,
+        llm: LLM,
+        max_sequences: int = 4,
+        slot_length: int = 4096,
+        prefill_chunk: int = 128,
+        n_batch: int = 512,
+        **kwargs,
+    ):
+        """
+        Serves several generations at once from one llama.cpp context (continuous batching). Every sequence
+        gets its own KV slot (sequence id) in a shared KV cache, and one decode step evaluates the next token of
+        every running sequence in a single batch. New requests join and finished ones leave between steps,
+        and prompts are evaluated in chunks of prefill_chunk tokens alongside the decode tokens, so a long prompt
+        does not stall the other users. The context shares the weights of llm, only the KV cache is extra.
+
+        Parameters
+        ----------
+        llm : LLM
+            The model, whose weights, tokenizer and context management are shared.
+        max_sequences : int, optional
+            The maximum number of sequences running at once (default is 4).
+        slot_length : int, optional
+            The prompt plus output tokens one sequence can hold, at most the context length of llm. The KV cache
+            holds max_sequences * slot_length tokens, so keep it small for long-context models (default is 4096).
+        prefill_chunk : int, optional
+            The maximum number of prompt tokens evaluated per sequence per step (default is 128).
+        n_batch : int, optional
+            The maximum number of tokens per decode step (default is 512).
+        **kwargs
+            n_threads and seed.
+        """
+        self.llm = llm
+        self.max_sequences = max_sequences
+        self.prefill_chunk = prefill_chunk
+        self.n_batch = n_batch
+        self.slot_length = min(slot_length, llm.llm.n_ctx())
+        self.n_vocab = llm.llm.n_vocab()
+        self.rng = np.random.default_rng(kwargs.get("seed", 1337))
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = self.slot_length * max_sequences
+        params.n_batch = n_batch
+        params.n_ubatch = n_batch
+        params.n_seq_max = max_sequences
+        params.n_threads = kwargs.get("n_threads", 8)
+        params.n_threads_batch = kwargs.get("n_threads", 8)
+        self.context = _internals.LlamaContext(model=llm.llm._model, params=params, verbose=False)
+        self.batch = _internals.LlamaBatch(n_tokens=n_batch, embd=0, n_seq_max=max_sequences, verbose=False)
+
+        self.pending = queue.Queue()
+        self.running: Dict[int, _Sequence] = {}
+        self.free_slots = list(range(max_sequences))
+        self.stats = {"steps": 0, "tokens": 0, "prompt_tokens": 0, "busy_seconds": 0.0, "batch_sizes": 0}
+        self.error: Optional[BaseException] = None
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def stream(self, messages: List[Dict[str, str]], **kwargs) -> Generator[str, None, None]:
+        """
+        Streams the output for the input messages like LLM.stream, scheduled together with all other
+        running requests.
+
+        Parameters
+        ----------
+        messages : List[Dict[str, str]]
+            A list of messages to be processed by the LLM.
+        **kwargs
+            max_tokens (default is 16, like llama_cpp), temperature, top_k, top_p and stop.
+
+        Yields
+        ------
+        str
+            Parts of the generated text by the LLM.
+
+        Raises
+        ------
+        Exception
+            The error that stopped the scheduler, or RuntimeError when it was closed.
+        """
+        prompt = self.llm._strip_bos_token(self.llm.ctx(messages))
+        prompt_tokens = self.llm.llm.tokenize(prompt.encode("utf-8"), add_bos=True, special=True)
+        stop = kwargs.get("stop") or []
+        max_tokens = kwargs.get("max_tokens") or 16
+        if max_tokens >= self.slot_length:
+            raise ValueError(
+                f"max_tokens ({max_tokens}) must be smaller than the slot length ({self.slot_length})."
+            )
+        sequence = _Sequence(
+            # keep room in the slot for the output
+            prompt_tokens[-(self.slot_length - max_tokens) :],
+            max_tokens,
+            {
+                "temperature": kwargs.get("temperature", 0.8),
+                "top_k": kwargs.get("top_k", 40),
+                "top_p": kwargs.get("top_p", 0.95),
+            },
+            [stop] if isinstance(stop, str) else list(stop),
+        )
+        with self._lock:
+            if self.error is not None:
+                raise self.error
+            self.pending.put(sequence)
+        try:
+            while True:
+                text = sequence.output.get()
+                if text is None:
+                    return
+                if isinstance(text, BaseException):
+                    raise text
+                yield text
+        finally:
+            # a consumer that stops reading frees its slot at the next step
+            sequence.cancelled = True
+
+    def throughput(self) -> Dict[str, float]:
+        """
+        Returns the aggregate generated tokens per busy second and the mean number of sequences per decode step.
+        """
+        steps = max(self.stats["steps"], 1)
+        return {
+            "tokens_per_second": self.stats["tokens"] / max(self.stats["busy_seconds"], 1e-9),
+            "mean_batch_size": self.stats["batch_sizes"] / steps,
+            "running": len(self.running),
+            "pending": self.pending.qsize(),
+        }
+
+    def close(self) -> None:
+        """
+        Stops the scheduler; running and pending requests end with a RuntimeError.
+        """
+        self._stopped = True
+        self.pending.put(None)
+        self._worker.join()
+        self.batch.close()
+        self.context.close()
+
+    def _admit(self) -> None:
+        # wait for work only when nothing is running
+        block = not self.running
+        while self.free_slots:
+            try:
+                sequence = self.pending.get(block=block)
+            except queue.Empty:
+                return
+            if sequence is None:
+                return
+            sequence.slot = self.free_slots.pop()
+            self.context.kv_cache_seq_rm(sequence.slot, -1, -1)
+            self.running[sequence.slot] = sequence
+            block = False
+
+    def _add_token(self, token: int, position: int, slot: int, logits: bool) -> int:
+        batch = self.batch.batch
+        index = batch.n_tokens
+        batch.token[index] = token
+        batch.pos[index] = position
+        batch.seq_id[index][0] = slot
+        batch.n_seq_id[index] = 1
+        batch.logits[index] = logits
+        batch.n_tokens = index + 1
+        return index
+
+    def _emit(self, sequence: _Sequence, token: Optional[int]) -> bool:
+        """
+        Appends a token to the text of a sequence and streams what can no longer become part of a stop string.
+        Returns whether the sequence is finished.
+        """
+        finished = token is None
+        if token is not None:
+            sequence.text += sequence.decoder.decode(self.llm.llm.detokenize([token]))
+        cut = len(sequence.text)
+        for stop in sequence.stop:
+            index = sequence.text.find(stop, sequence.emitted)
+            if index != -1:
+                cut, finished = min(cut, index), True
+        if not finished and sequence.stop:
+            cut = max(sequence.emitted, len(sequence.text) - max(len(stop) for stop in sequence.stop) + 1)
+        if cut > sequence.emitted:
+            sequence.output.put(sequence.text[sequence.emitted : cut])
+            sequence.emitted = cut
+        return finished
+
+    def _finish(self, sequence: _Sequence) -> None:
+        self.context.kv_cache_seq_rm(sequence.slot, -1, -1)
+        del self.running[sequence.slot]
+        self.free_slots.append(sequence.slot)
+        sequence.output.put(None)
+
+    def _fail_all(self, error: BaseException) -> None:
+        # every running and queued request receives the error instead of waiting forever
+        with self._lock:
+            self.error = error
+            for sequence in self.running.values():
+                sequence.output.put(error)
+            self.running.clear()
+            while not self.pending.empty():
+                sequence = self.pending.get_nowait()
+                if sequence is not None:
+                    sequence.output.put(error)
+
+    def _run(self) -> None:
+        try:
+            while not self._stopped:
+                self._step()
+            error = RuntimeError("The BatchScheduler was closed.")
+        except Exception as e:
+            error = e
+        self._fail_all(error)
+
+    def _step(self) -> None:
+        self._admit()
+        for sequence in [sequence for sequence in self.running.values() if sequence.cancelled]:
+            self._finish(sequence)
+        if not self.running:
+            return
+
+        start = time.time()
+        self.batch.reset()
+        sample_at = {}
+        # decode tokens first, so running sequences advance every step
+        for slot, sequence in self.running.items():
+            if sequence.last_token is not None:
+                sample_at[slot] = self._add_token(sequence.last_token, sequence.position, slot, True)
+                sequence.position += 1
+        # then prompt chunks, as far as the batch allows
+        for slot, sequence in self.running.items():
+            remaining = len(sequence.prompt_tokens) - sequence.position
+            if sequence.last_token is not None or remaining <= 0:
+                continue
+            chunk = min(remaining, self.prefill_chunk, self.n_batch - self.batch.n_tokens())
+            for offset in range(chunk):
+                last = offset == remaining - 1
+                index = self._add_token(
+                    sequence.prompt_tokens[sequence.position], sequence.position, slot, last
+                )
+                sequence.position += 1
+                if last:
+                    sample_at[slot] = index
+            self.stats["prompt_tokens"] += chunk
+        if self.batch.n_tokens() == 0:
+            return
+        with span("batch.decode", sequences=len(self.running), tokens=self.batch.n_tokens()):
+            self.context.decode(self.batch)
+
+        for slot, index in sample_at.items():
+            sequence = self.running[slot]
+            logits = np.ctypeslib.as_array(self.context.get_logits_ith(index), shape=(self.n_vocab,))
+            token = sample_token(logits, rng=self.rng, **sequence.sampling)
+            sequence.generated += 1
+            self.stats["tokens"] += 1
+            if llama_cpp.llama_token_is_eog(self.llm.llm.model, token):
+                finished = self._emit(sequence, None)
+            else:
+                finished = self._emit(sequence, token)
+                sequence.last_token = token
+            if (
+                finished
+                or sequence.generated >= sequence.max_tokens
+                or sequence.position >= self.slot_length
+            ):
+                sequence.text += sequence.decoder.decode(b"", final=True)
+                self._emit(sequence, None)
+                self._finish(sequence)
+
+        self.stats["steps"] += 1
+        self.stats["batch_sizes"] += len(sample_at)
+        self.stats["busy_seconds"] += time.time() - start
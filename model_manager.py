@@ -0,0 +1,237 @@
+# model_manager.py
+
+import gc
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+import pandas as pd
+import psutil
+
+
+def rss_mb() -> float:
+    """
+    Returns the resident memory of this process in MB.
+    """
+    return psutil.Process().memory_info().rss / 2**20
+
+
+class _ManagedModel:
+    def __init__(self, name: str, loader: Callable[[], Any], mmap_backed: bool, estimate_mb: float):
+        self.name = name
+        self.loader = loader
+        self.mmap_backed = mmap_backed
+        self.estimate_mb = estimate_mb
+        self.model = None
+        self.resident_mb = 0.0
+        self.in_use = 0
+        self.last_used = 0.0
+        self.loads = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+        self.unload_seconds = 0.0
+        # serializes loads of this model only, other models stay available while it loads
+        self.load_lock = threading.Lock()
+
+
+class ModelManager:
+    def __init__(self, rss_budget_mb: float, max_idle_seconds: Optional[float] = None):
+        """
+        Loads models lazily on first use and keeps the resident memory of the process under a budget
+        by unloading idle models, least recently used first. Models whose weights are memory-mapped files
+        are unloaded before the others: their pages stay in the OS page cache, so reloading them is cheap,
+        while a model with weights copied into process memory has to be read and converted again.
+
+        Parameters
+        ----------
+        rss_budget_mb : float
+            The resident memory budget of the process in MB.
+        max_idle_seconds : float, optional
+            Also unload models not used for this many seconds, regardless of the budget (default is None).
+        """
+        self.rss_budget_mb = rss_budget_mb
+        self.max_idle_seconds = max_idle_seconds
+        self.models: Dict[str, _ManagedModel] = {}
+        self.lock = threading.RLock()
+
+    def register(
+        self, name: str, loader: Callable[[], Any], mmap_backed: bool = False, estimate_mb: float = 0.0
+    ) -> None:
+        """
+        Registers a model without loading it.
+
+        Parameters
+        ----------
+        name : str
+            The name to get the model by.
+        loader : Callable[[], Any]
+            Creates the model.
+        mmap_backed : bool, optional
+            Whether the weights are memory-mapped, which makes the model cheap to reload (default is False).
+        estimate_mb : float, optional
+            The expected resident memory of the model, used to make room before its first load; afterwards
+            the measured memory is used (default is 0.0). The pages of a memory-mapped file only become
+            resident as they are read, so for an mmap-backed model the measurement right after loading
+            can be far too low; the estimate, e.g. the file size, is then used as a lower bound.
+        """
+        with self.lock:
+            self.models[name] = _ManagedModel(name, loader, mmap_backed, estimate_mb)
+
+    def register_llm(self, name: str, estimate_mb: Optional[float] = None, **llm_kwargs) -> None:
+        """
+        Registers an llm_invoke.LLM. llama.cpp memory-maps GGUF files by default, so the estimate defaults
+        to the size of the model file.
+        """
+        from llm_invoke import LLM
+
+        if estimate_mb is None:
+            model_path = llm_kwargs.get("model_path")
+            estimate_mb = os.path.getsize(model_path) / 2**20 if model_path and os.path.isfile(model_path) else 0.0
+        self.register(name, lambda: LLM(**llm_kwargs), mmap_backed=True, estimate_mb=estimate_mb)
+
+    def register_phi_processor(self, name: str, estimate_mb: float = 0.0, **processor_kwargs) -> None:
+        """
+        Registers a poc_ocr2.PhiProcessor. Its weights are memory-mapped when loaded with mmap_weights
+        in cpu_mode "bfloat16", the dtype of the safetensors files.
+        """
+        from poc_ocr2 import PhiProcessor
+
+        mmap_backed = (
+            processor_kwargs.get("mmap_weights", False)
+            and processor_kwargs.get("cpu_mode", "float32") == "bfloat16"
+        )
+        self.register(
+            name, lambda: PhiProcessor(**processor_kwargs), mmap_backed=mmap_backed, estimate_mb=estimate_mb
+        )
+
+    def get(self, name: str) -> Any:
+        """
+        Returns a model, loading it first if needed. The returned model may be unloaded by the manager later,
+        which only drops the manager's reference; hold it with use to keep it loaded while working with it.
+        A model loads outside of the manager's lock, so other models can be used in the meantime; concurrent
+        loads of other models do inflate each other's measured memory.
+        """
+        with self.lock:
+            managed = self.models[name]
+            managed.last_used = time.time()
+            self._unload_idle_models()
+            if managed.model is not None:
+                return managed.model
+        with managed.load_lock:
+            with self.lock:
+                # loaded by another thread while this one waited
+                if managed.model is not None:
+                    return managed.model
+                self._make_room(managed.resident_mb or managed.estimate_mb, keep=name)
+            before = rss_mb()
+            start = time.time()
+            model = managed.loader()
+            load_seconds = time.time() - start
+            resident_mb = max(rss_mb() - before, 0.0)
+            with self.lock:
+                managed.model = model
+                managed.load_seconds += load_seconds
+                managed.loads += 1
+                if managed.mmap_backed:
+                    resident_mb = max(resident_mb, managed.estimate_mb)
+                managed.resident_mb = resident_mb
+                managed.last_used = time.time()
+                self._make_room(0.0, keep=name)
+            return model
+
+    @contextmanager
+    def use(self, name: str):
+        """
+        Gets a model and keeps it from being unloaded until the block ends.
+        """
+        while True:
+            model = self.get(name)
+            with self.lock:
+                # another thread may have unloaded it between get and here
+                if self.models[name].model is model:
+                    self.models[name].in_use += 1
+                    break
+        try:
+            yield model
+        finally:
+            with self.lock:
+                self.models[name].in_use -= 1
+                self.models[name].last_used = time.time()
+
+    def unload(self, name: str) -> None:
+        """
+        Unloads a model. Its memory is released once no caller holds a reference to it anymore.
+        """
+        with self.lock:
+            managed = self.models[name]
+            if managed.model is None:
+                return
+            start = time.time()
+            managed.model = None
+            gc.collect()
+            managed.unload_seconds += time.time() - start
+            managed.evictions += 1
+
+    def _make_room(self, needed_mb: float, keep: str) -> None:
+        # mmap-backed models first, each group least recently used first
+        candidates = sorted(
+            (
+                managed
+                for managed in self.models.values()
+                if managed.model is not None and managed.in_use == 0 and managed.name != keep
+            ),
+            key=lambda managed: (not managed.mmap_backed, managed.last_used),
+        )
+        for managed in candidates:
+            if rss_mb() + needed_mb <= self.rss_budget_mb:
+                return
+            self.unload(managed.name)
+
+    def _unload_idle_models(self) -> None:
+        if self.max_idle_seconds is None:
+            return
+        now = time.time()
+        for managed in self.models.values():
+            if (
+                managed.model is not None
+                and managed.in_use == 0
+                and now - managed.last_used > self.max_idle_seconds
+            ):
+                self.unload(managed.name)
+
+    def memory_usage(self) -> Dict[str, float]:
+        """
+        Returns the resident memory of the process, the budget and the measured memory of the loaded models in MB.
+        """
+        with self.lock:
+            return {
+                "rss_mb": rss_mb(),
+                "budget_mb": self.rss_budget_mb,
+                "models_mb": sum(
+                    managed.resident_mb for managed in self.models.values() if managed.model is not None
+                ),
+            }
+
+    def stats(self) -> pd.DataFrame:
+        """
+        Returns per model whether it is loaded and in use, its measured memory, and its number of loads and
+        evictions with their mean duration in seconds.
+        """
+        with self.lock:
+            return pd.DataFrame(
+                [
+                    {
+                        "model": managed.name,
+                        "loaded": managed.model is not None,
+                        "in_use": managed.in_use,
+                        "mmap_backed": managed.mmap_backed,
+                        "resident_mb": managed.resident_mb,
+                        "loads": managed.loads,
+                        "evictions": managed.evictions,
+                        "mean_load_seconds": managed.load_seconds / max(managed.loads, 1),
+                        "mean_unload_seconds": managed.unload_seconds / max(managed.evictions, 1),
+                    }
+                    for managed in self.models.values()
+                ]
+            ).set_index("model")
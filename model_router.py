@@ -0,0 +1,301 @@
+# model_router.py
+
+import re
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Callable, Dict, Generator, List, Optional, Tuple, Union
+import pandas as pd
+from llm_invoke import LLM
+
+
+class ModelRoute:
+    def __init__(
+        self,
+        name: str,
+        llm: Union[LLM, Callable[[], LLM]],
+        context_length: int,
+        prompt_seconds_per_token: float,
+        seconds_per_token: float,
+        tasks: Optional[List[str]] = None,
+        manager=None,
+    ):
+        """
+        A model the router can send requests to, ordered from cheap to expensive in ModelRouter.
+
+        Parameters
+        ----------
+        name : str
+            The name of the route in decisions and summaries.
+        llm : Union[LLM, Callable[[], LLM]]
+            The model, or a function returning it, so a model is only loaded when it is first routed to.
+        context_length : int
+            The context length the model was created with; prompt and output tokens must fit in it.
+        prompt_seconds_per_token, seconds_per_token : float
+            The initial estimate of prompt evaluation and decode time per token, replaced by measurements
+            as requests complete (see the llama_print_timings of a run).
+        tasks : List[str], optional
+            The task types the model may serve (default is None, all tasks).
+        manager : model_manager.ModelManager, optional
+            The manager the model is registered with under the route name; the model is then pinned with
+            ModelManager.use while it generates, so it is not evicted mid-generation (default is None).
+        """
+        self.name = name
+        self._llm = llm
+        self.context_length = context_length
+        self.prompt_seconds_per_token = prompt_seconds_per_token
+        self.seconds_per_token = seconds_per_token
+        self.tasks = tasks
+        self.manager = manager
+
+    @property
+    def llm(self) -> LLM:
+        return self._llm if isinstance(self._llm, LLM) else self._llm()
+
+    @contextmanager
+    def use(self) -> Generator[LLM, None, None]:
+        """
+        Provides the model for one generation, keeping a managed model loaded until the block ends.
+        """
+        if self.manager is None:
+            yield self.llm
+            return
+        with self.manager.use(self.name) as llm:
+            yield llm
+
+    def estimate_seconds(self, prompt_tokens: int, max_tokens: int) -> float:
+        return prompt_tokens * self.prompt_seconds_per_token + max_tokens * self.seconds_per_token
+
+    def update(self, prompt_tokens: int, stats: Dict[str, float], smoothing: float = 0.3) -> None:
+        """
+        Updates the decode time estimate from the stats of a completed generation (LLM.last_stats),
+        as an exponential moving average. Decode time is what remains after the estimated prompt evaluation.
+        """
+        if not stats.get("tokens"):
+            return
+        decode_seconds = stats["seconds"] - prompt_tokens * self.prompt_seconds_per_token
+        measured = max(decode_seconds, 0.0) / stats["tokens"]
+        self.seconds_per_token += smoothing * (measured - self.seconds_per_token)
+
+
+def basic_quality_check(text: str, min_words: int = 5, max_repeated_share: float = 0.3) -> bool:
+    """
+    A cheap check for clearly failed generations: too short, or dominated by repeated word trigrams.
+    """
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < min_words:
+        return False
+    trigrams = list(zip(words, words[1:], words[2:]))
+    repeated = len(trigrams) - len(set(trigrams))
+    return repeated <= max_repeated_share * max(len(trigrams), 1)
+
+
+class ModelRouter:
+    def __init__(
+        self,
+        routes: List[ModelRoute],
+        count_tokens: Callable[[str], int],
+        quality_check: Optional[Callable[[str], bool]] = None,
+    ):
+        """
+        Picks a model per request from the prompt token count, the task type and a latency target, and can
+        escalate to a bigger model when a cheap quality check of the output fails. Every decision and its
+        latency is recorded.
+
+        Parameters
+        ----------
+        routes : List[ModelRoute]
+            The routes, from cheapest to most capable.
+        count_tokens : Callable[[str], int]
+            Counts the tokens of a message, e.g. LLM.ctx.__count_tokens__ or a tokenizer of the model family.
+        quality_check : Callable[[str], bool], optional
+            Decides whether an output is good enough, e.g. basic_quality_check (default is None, no escalation).
+        """
+        self.routes = routes
+        self.count_tokens = count_tokens
+        self.quality_check = quality_check
+        self.decisions: List[Dict] = []
+
+    def prompt_tokens(self, messages: List[Dict[str, str]]) -> int:
+        # a few tokens of chat template per message
+        return sum(self.count_tokens(message["content"]) + 4 for message in messages)
+
+    def candidates(
+        self,
+        prompt_tokens: int,
+        max_tokens: int,
+        task: Optional[str] = None,
+        latency_target: Optional[float] = None,
+    ) -> List[ModelRoute]:
+        """
+        Returns the routes that can serve a request, the preferred route first: the cheapest route whose
+        estimated latency meets the target, or the fastest route when none does, followed by the more
+        capable routes to escalate to.
+        """
+        eligible = [
+            route
+            for route in self.routes
+            if prompt_tokens + max_tokens <= route.context_length
+            and (route.tasks is None or task in route.tasks)
+        ]
+        if not eligible:
+            raise ValueError(
+                f"No route fits a request of {prompt_tokens} prompt tokens and {max_tokens} output tokens"
+                f" for task {task}."
+            )
+        if latency_target is None:
+            return eligible
+        estimates = [route.estimate_seconds(prompt_tokens, max_tokens) for route in eligible]
+        meeting = [index for index, seconds in enumerate(estimates) if seconds <= latency_target]
+        first = meeting[0] if meeting else min(range(len(eligible)), key=lambda index: estimates[index])
+        return eligible[first:]
+
+    def _record(
+        self, route: ModelRoute, task: Optional[str], prompt_tokens: int, max_tokens: int, **fields
+    ) -> Dict:
+        decision = {
+            "route": route.name,
+            "task": task,
+            "prompt_tokens": prompt_tokens,
+            "estimated_seconds": route.estimate_seconds(prompt_tokens, max_tokens),
+            **fields,
+        }
+        self.decisions.append(decision)
+        return decision
+
+    def complete(
+        self,
+        messages: List[Dict[str, str]],
+        task: Optional[str] = None,
+        latency_target: Optional[float] = None,
+        **kwargs,
+    ) -> Tuple[str, str]:
+        """
+        Completes the messages on the chosen route, escalating to the next route while the quality check fails.
+
+        Parameters
+        ----------
+        messages : List[Dict[str, str]]
+            A list of messages to be processed by the LLM.
+        task : str, optional
+            The task type, e.g. "summary" or "code" (default is None).
+        latency_target : float, optional
+            The target latency in seconds (default is None, the cheapest fitting route).
+        **kwargs
+            Additional keyword arguments for the LLM, max_tokens defaults to 512.
+
+        Returns
+        -------
+        Tuple[str, str]
+            The output and the name of the route that produced it.
+        """
+        kwargs.setdefault("max_tokens", 512)
+        prompt_tokens = self.prompt_tokens(messages)
+        routes = self.candidates(prompt_tokens, kwargs["max_tokens"], task, latency_target)
+        escalated_from = None
+        for route in routes:
+            with route.use() as llm:
+                start = time.time()
+                output = llm.complete(messages, **kwargs)
+                seconds = time.time() - start
+            route.update(prompt_tokens, llm.last_stats)
+            passed = self.quality_check is None or self.quality_check(output)
+            self._record(
+                route,
+                task,
+                prompt_tokens,
+                kwargs["max_tokens"],
+                seconds=seconds,
+                tokens=llm.last_stats.get("tokens", 0),
+                escalated_from=escalated_from,
+                passed=passed,
+            )
+            if passed:
+                break
+            escalated_from = route.name
+        # the output of the most capable route when every route failed the check
+        return output, route.name
+
+    def stream(
+        self,
+        messages: List[Dict[str, str]],
+        task: Optional[str] = None,
+        latency_target: Optional[float] = None,
+        **kwargs,
+    ) -> Generator[str, None, None]:
+        """
+        Streams the output of the chosen route like LLM.stream. Streamed output can not be taken back,
+        so streaming never escalates; use complete for that.
+        """
+        kwargs.setdefault("max_tokens", 512)
+        prompt_tokens = self.prompt_tokens(messages)
+        route = self.candidates(prompt_tokens, kwargs["max_tokens"], task, latency_target)[0]
+        start = time.time()
+        # the model stays pinned until the stream is exhausted or closed
+        with route.use() as llm:
+            yield from llm.stream(messages, **kwargs)
+        route.update(prompt_tokens, llm.last_stats)
+        self._record(
+            route,
+            task,
+            prompt_tokens,
+            kwargs["max_tokens"],
+            seconds=time.time() - start,
+            tokens=llm.last_stats.get("tokens", 0),
+            escalated_from=None,
+            passed=None,
+        )
+
+    def latency_summary(self) -> pd.DataFrame:
+        """
+        Returns per route the number of requests, escalations away from it, and the mean and 95th percentile
+        latency and tokens per second.
+        """
+        if not self.decisions:
+            return pd.DataFrame()
+        decisions = pd.DataFrame(self.decisions)
+        decisions["tokens_per_second"] = decisions["tokens"] / decisions["seconds"].clip(lower=1e-9)
+        grouped = decisions.groupby("route")
+        return pd.DataFrame(
+            {
+                "requests": grouped.size(),
+                "failed_quality_check": grouped["passed"].apply(lambda passed: int((passed == False).sum())),
+                "mean_seconds": grouped["seconds"].mean(),
+                "p95_seconds": grouped["seconds"].quantile(0.95),
+                "tokens_per_second": grouped["tokens_per_second"].mean(),
+            }
+        )
+
+
+def create_default_router(
+    quality_check: Optional[Callable[[str], bool]] = basic_quality_check, manager=None
+) -> ModelRouter:
+    """
+    Creates a router over the models of the scripts, loaded on first use: fietje 4k Q5_K_M for short Dutch
+    requests, phi-3-mini-128k Q5_K_M for long prompts and phi-3-mini-128k Q8_0 as the most capable fallback.
+    The initial time estimates follow the llama_print_timings in the README and are refined by measurements.
+    With a model_manager.ModelManager, the models are registered with it and unloaded under its memory budget,
+    but never while generating; without one, a model stays loaded once used.
+    """
+    from transformers import AutoTokenizer
+
+    # name, model path, tokenizer, context length, prompt and decode seconds per token
+    models = [
+        ("fietje-4k-Q5_K_M", "./model/fietje-3-mini-4k-instruct-Q5_K_M.gguf",
+         "microsoft/Phi-3-mini-4k-instruct", 4096, 0.021, 0.065),
+        ("phi-3-mini-128k-Q5_K_M", "./model/phi-3-mini-128k-instruct.Q5_K_M.gguf",
+         "microsoft/Phi-3-mini-128k-instruct", 32000, 0.022, 0.07),
+        ("phi-3-mini-128k-Q8_0", "./model/phi-3-mini-128k-instruct.Q8_0.gguf",
+         "microsoft/Phi-3-mini-128k-instruct", 40000, 0.03, 0.095),
+    ]
+    routes = []
+    for name, model_path, tokenizer_path, context_length, prompt_seconds, seconds in models:
+        llm_kwargs = {"tokenizer_path": tokenizer_path, "model_path": model_path, "context_length": context_length}
+        if manager is not None:
+            manager.register_llm(name, **llm_kwargs)
+            llm = lambda name=name: manager.get(name)
+        else:
+            llm = lru_cache(maxsize=1)(lambda llm_kwargs=llm_kwargs: LLM(**llm_kwargs))
+        routes.append(ModelRoute(name, llm, context_length, prompt_seconds, seconds, manager=manager))
+    tokenizer = AutoTokenizer.from_pretrained("microsoft/Phi-3-mini-4k-instruct")
+    return ModelRouter(routes, lambda text: len(tokenizer.tokenize(text)), quality_check)
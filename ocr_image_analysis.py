@@ -0,0 +1,364 @@
+# ocr_image_analysis.py
+
+import json
+import math
+from typing import Dict, Optional, Tuple
+import numpy as np
+from PIL import Image
+
+
+# Phi-3-vision cuts images into crops of CROP_SIZE x CROP_SIZE pixels
+CROP_SIZE = 336
+
+
+def to_grayscale_array(image: Image.Image, max_side: int = 512) -> np.ndarray:
+    """
+    Converts an image into a downscaled grayscale array, which keeps the statistics cheap to compute.
+
+    Parameters
+    ----------
+    image : Image.Image
+        The input image.
+    max_side : int, optional
+        The maximum width or height of the downscaled image (default is 512).
+
+    Returns
+    -------
+    np.ndarray
+        A float32 array with values between 0.0 and 1.0.
+    """
+    gray = image.convert("L")
+    gray.thumbnail((max_side, max_side), Image.BILINEAR)
+    return np.asarray(gray, dtype=np.float32) / 255.0
+
+
+def edge_map(gray: np.ndarray, threshold: float = 0.15) -> np.ndarray:
+    """
+    Returns a boolean map of pixels with a strong horizontal or vertical gradient.
+
+    Parameters
+    ----------
+    gray : np.ndarray
+        The grayscale array as returned by to_grayscale_array.
+    threshold : float, optional
+        The minimum absolute intensity difference between neighbouring pixels (default is 0.15).
+
+    Returns
+    -------
+    np.ndarray
+        The boolean edge map, with the same shape as the input.
+    """
+    edges = np.zeros(gray.shape, dtype=bool)
+    edges[:, 1:] |= np.abs(np.diff(gray, axis=1)) > threshold
+    edges[1:, :] |= np.abs(np.diff(gray, axis=0)) > threshold
+    return edges
+
+
+def text_density(gray: np.ndarray, block_size: int = 16, threshold: float = 0.15) -> float:
+    """
+    Estimates the fraction of the image that is covered by text-like regions.
+    Text shows up as blocks with many edges, so the image is divided into blocks and the
+    fraction of blocks with an edge density typical for text is returned.
+
+    Parameters
+    ----------
+    gray : np.ndarray
+        The grayscale array as returned by to_grayscale_array.
+    block_size : int, optional
+        The block size in pixels of the downscaled image (default is 16).
+    threshold : float, optional
+        The gradient threshold passed to edge_map (default is 0.15).
+
+    Returns
+    -------
+    float
+        The fraction (0.0 - 1.0) of blocks that look like text.
+    """
+    edges = edge_map(gray, threshold)
+    rows = edges.shape[0] // block_size
+    cols = edges.shape[1] // block_size
+    if rows == 0 or cols == 0:
+        return float(edges.mean())
+    blocks = edges[: rows * block_size, : cols * block_size].reshape(
+        rows, block_size, cols, block_size
+    )
+    block_density = blocks.mean(axis=(1, 3))
+    return float(((block_density > 0.05) & (block_density < 0.6)).mean())
+
+
+def otsu_threshold(gray: np.ndarray, bins: int = 256) -> float:
+    """
+    Computes the threshold that best separates the grayscale values into two classes (Otsu's method).
+
+    Parameters
+    ----------
+    gray : np.ndarray
+        The grayscale array as returned by to_grayscale_array.
+    bins : int, optional
+        The number of histogram bins (default is 256).
+
+    Returns
+    -------
+    float
+        The threshold between 0.0 and 1.0.
+    """
+    histogram, bin_edges = np.histogram(gray, bins=bins, range=(0.0, 1.0))
+    centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+    weight_low = np.cumsum(histogram)
+    weight_high = weight_low[-1] - weight_low
+    cumulative_mean = np.cumsum(histogram * centers)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_low = cumulative_mean / weight_low
+        mean_high = (cumulative_mean[-1] - cumulative_mean) / weight_high
+        between_variance = weight_low * weight_high * (mean_low - mean_high) ** 2
+    return float(centers[np.nanargmax(np.nan_to_num(between_variance, nan=-1.0))])
+
+
+def count_components(mask: np.ndarray) -> int:
+    """
+    Estimates the number of 8-connected components in a boolean mask by its Euler number
+    (components minus holes), computed from 2x2 pixel patterns in a single vectorised pass.
+    For text, where most glyphs have at most one hole, this is close to the number of glyphs.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        The boolean mask.
+
+    Returns
+    -------
+    int
+        The estimated number of components, never below 0.
+    """
+    padded = np.pad(mask, 1).astype(np.int8)
+    a, b = padded[:-1, :-1], padded[:-1, 1:]
+    c, d = padded[1:, :-1], padded[1:, 1:]
+    quad_sum = a + b + c + d
+    n_single = np.count_nonzero(quad_sum == 1)
+    n_triple = np.count_nonzero(quad_sum == 3)
+    n_diagonal = np.count_nonzero((quad_sum == 2) & (a == d))
+    return max((n_single - n_triple - 2 * n_diagonal) // 4, 0)
+
+
+def estimate_image_tokens(width: int, height: int, num_crops: int) -> int:
+    """
+    Estimates the number of image tokens Phi-3-vision produces for an image, following the HD transform
+    of its image processor.
+
+    Parameters
+    ----------
+    width : int
+        The width of the image in pixels.
+    height : int
+        The height of the image in pixels.
+    num_crops : int
+        The maximum number of crops of the image processor.
+
+    Returns
+    -------
+    int
+        The estimated number of image tokens.
+    """
+    transposed = width < height
+    if transposed:
+        width, height = height, width
+    ratio = width / height
+    scale = 1
+    while scale * math.ceil(scale / ratio) <= num_crops:
+        scale += 1
+    scale -= 1
+    new_width = scale * CROP_SIZE
+    new_height = math.ceil(int(new_width / ratio) / CROP_SIZE) * CROP_SIZE
+    if transposed:
+        new_width, new_height = new_height, new_width
+    return int(
+        (new_height // CROP_SIZE * new_width // CROP_SIZE + 1) * 144
+        + 1
+        + (new_height // CROP_SIZE + 1) * 12
+    )
+
+
+class AdaptiveCropPolicy:
+    def __init__(
+        self,
+        min_crops: int = 1,
+        max_crops: int = 16,
+        min_image_tokens: int = 0,
+        max_image_tokens: int = 2500,
+        dense_text_density: float = 0.5,
+    ):
+        """
+        Chooses the number of Phi-3-vision crops per image, so small or sparse images get few image tokens
+        and large, dense scans get enough resolution to read all text.
+
+        Parameters
+        ----------
+        min_crops : int, optional
+            The minimum number of crops (default is 1).
+        max_crops : int, optional
+            The maximum number of crops (default is 16, the processor default).
+        min_image_tokens : int, optional
+            The minimum image token budget per image (default is 0).
+        max_image_tokens : int, optional
+            The maximum image token budget per image (default is 2500).
+        dense_text_density : float, optional
+            The text density at which an image gets all the crops its resolution supports (default is 0.5).
+        """
+        if not 1 <= min_crops <= max_crops:
+            raise ValueError("Crops must satisfy 1 <= min_crops <= max_crops.")
+        if min_image_tokens > max_image_tokens:
+            raise ValueError("min_image_tokens must not exceed max_image_tokens.")
+
+        self.min_crops = min_crops
+        self.max_crops = max_crops
+        self.min_image_tokens = min_image_tokens
+        self.max_image_tokens = max_image_tokens
+        self.dense_text_density = dense_text_density
+
+    def choose_num_crops(self, image: Image.Image) -> int:
+        """
+        Chooses the number of crops for the image from its dimensions and text density.
+
+        Parameters
+        ----------
+        image : Image.Image
+            The input image.
+
+        Returns
+        -------
+        int
+            The number of crops to use for the image.
+        """
+        width, height = image.size
+        native_crops = math.ceil(width / CROP_SIZE) * math.ceil(height / CROP_SIZE)
+        fill = min(max(text_density(to_grayscale_array(image)) / self.dense_text_density, 0.1), 1.0)
+        num_crops = min(max(round(native_crops * fill), self.min_crops), self.max_crops)
+
+        while (
+            num_crops > self.min_crops
+            and estimate_image_tokens(width, height, num_crops) > self.max_image_tokens
+        ):
+            num_crops -= 1
+        while (
+            num_crops < self.max_crops
+            and estimate_image_tokens(width, height, num_crops) < self.min_image_tokens
+        ):
+            num_crops += 1
+        return num_crops
+
+
+class ImageTriage:
+    NO_TEXT = "no_text"
+    SPARSE = "sparse"
+    DENSE = "dense"
+
+    def __init__(
+        self,
+        min_contrast: float = 0.05,
+        min_components: int = 15,
+        dense_components: int = 400,
+        dense_text_density: float = 0.3,
+        max_ink_ratio: float = 0.35,
+        sparse_max_new_tokens: int = 500,
+        log_path: Optional[str] = None,
+    ):
+        """
+        Classifies images as containing no text, sparse text or dense text from cheap image statistics,
+        so text-free images can be skipped before running the vision model.
+
+        Parameters
+        ----------
+        min_contrast : float, optional
+            Images with a lower grayscale standard deviation are considered blank (default is 0.05).
+        min_components : int, optional
+            Images with fewer ink components are considered to contain no text (default is 15).
+        dense_components : int, optional
+            Images with at least this many ink components are considered dense (default is 400).
+        dense_text_density : float, optional
+            Images with at least this text density are considered dense (default is 0.3).
+        max_ink_ratio : float, optional
+            Images with a larger ink (minority class) ratio after binarization look like photos rather
+            than documents and are considered to contain no text, unless they are dense (default is 0.35).
+        sparse_max_new_tokens : int, optional
+            The maximum number of new tokens to generate for sparse images (default is 500).
+        log_path : str, optional
+            A JSON lines file to which every decision and its statistics are appended, for tuning
+            the thresholds (default is None, only printing the decision).
+        """
+        self.min_contrast = min_contrast
+        self.min_components = min_components
+        self.dense_components = dense_components
+        self.dense_text_density = dense_text_density
+        self.max_ink_ratio = max_ink_ratio
+        self.sparse_max_new_tokens = sparse_max_new_tokens
+        self.log_path = log_path
+
+    def measure(self, image: Image.Image) -> Dict[str, float]:
+        """
+        Computes the statistics used for classifying the image.
+
+        Parameters
+        ----------
+        image : Image.Image
+            The input image.
+
+        Returns
+        -------
+        Dict[str, float]
+            The contrast, edge density, text density, ink ratio and number of ink components.
+        """
+        gray = to_grayscale_array(image)
+        ink = gray < otsu_threshold(gray)
+        # text is the minority class, both for dark-on-light and light-on-dark documents
+        if ink.mean() > 0.5:
+            ink = ~ink
+        return {
+            "contrast": float(gray.std()),
+            "edge_density": float(edge_map(gray).mean()),
+            "text_density": text_density(gray),
+            "ink_ratio": float(ink.mean()),
+            "components": count_components(ink),
+        }
+
+    def classify(self, image: Image.Image) -> Tuple[str, Dict[str, float]]:
+        """
+        Classifies the image as NO_TEXT, SPARSE or DENSE.
+
+        Parameters
+        ----------
+        image : Image.Image
+            The input image.
+
+        Returns
+        -------
+        Tuple[str, Dict[str, float]]
+            The decision and the statistics it was based on.
+        """
+        stats = self.measure(image)
+        dense = (
+            stats["components"] >= self.dense_components
+            and stats["text_density"] >= self.dense_text_density
+        )
+        if dense:
+            decision = self.DENSE
+        elif (
+            stats["contrast"] < self.min_contrast
+            or stats["components"] < self.min_components
+            or stats["ink_ratio"] > self.max_ink_ratio
+        ):
+            decision = self.NO_TEXT
+        else:
+            decision = self.SPARSE
+        return decision, stats
+
+    def log(self, filename: str, decision: str, stats: Dict[str, float]) -> None:
+        """
+        Prints the decision and appends it with its statistics to the log file, if configured.
+        """
+        print(
+            f"Triage {filename}: {decision} "
+            + " ".join(f"{key}={value:.3g}" for key, value in stats.items())
+        )
+        if self.log_path is not None:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"file": filename, "decision": decision, **stats}) + "\n")
@@ -0,0 +1,304 @@
+# ocr_workers.py
+
+import multiprocessing as mp
+import os
+import queue
+import time
+import traceback
+from typing import Dict, Generator, List, Optional
+
+
+def available_cores() -> List[int]:
+    """
+    Returns the ids of the CPU cores this process is allowed to run on.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def partition_cores(
+    num_workers: int, cores: Optional[List[int]] = None
+) -> List[List[int]]:
+    """
+    Splits the cores into disjoint, contiguous slices of (nearly) equal size, one per worker.
+    Contiguous slices keep the cores of a worker on the same socket and share its caches.
+
+    Parameters
+    ----------
+    num_workers : int
+        The number of workers.
+    cores : List[int], optional
+        The cores to partition (default is all cores available to this process).
+
+    Returns
+    -------
+    List[List[int]]
+        The cores of every worker.
+    """
+    cores = cores if cores is not None else available_cores()
+    if not 1 <= num_workers <= len(cores):
+        raise ValueError(f"Number of workers must be between 1 and {len(cores)}.")
+    size, remainder = divmod(len(cores), num_workers)
+    slices = []
+    start = 0
+    for worker_id in range(num_workers):
+        end = start + size + (1 if worker_id < remainder else 0)
+        slices.append(cores[start:end])
+        start = end
+    return slices
+
+
+def _worker_main(
+    worker_id: int,
+    cores: List[int],
+    processor_kwargs: Dict,
+    task_queue: mp.Queue,
+    result_queue: mp.Queue,
+) -> None:
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    elif worker_id == 0:
+        print("Core pinning is not supported on this platform, workers only limit their thread count")
+    # the environment only sizes the thread pools if torch is not imported yet, which spawn does when the
+    # main module imports it; PhiProcessor therefore also calls torch.set_num_threads(num_threads)
+    os.environ["OMP_NUM_THREADS"] = str(len(cores))
+    os.environ["MKL_NUM_THREADS"] = str(len(cores))
+
+    try:
+        from PIL import Image
+        from poc_ocr2 import PhiProcessor
+
+        ocr_processor = PhiProcessor(
+            device="cpu", num_threads=len(cores), stream_output=False, **processor_kwargs
+        )
+    except Exception:
+        # the parent is waiting for this worker to be ready, tell it why it never will be
+        result_queue.put(("error", {"worker_id": worker_id, "error": traceback.format_exc()}))
+        return
+    result_queue.put(("ready", {"worker_id": worker_id}))
+
+    while True:
+        image_path = task_queue.get()
+        if image_path is None:
+            break
+        start = time.time()
+        try:
+            with Image.open(image_path) as image:
+                text = ocr_processor.process_input_data(image)
+            error = None
+        except Exception as e:
+            text, error = "", str(e)
+        result_queue.put(
+            (
+                "result",
+                {
+                    "image_path": image_path,
+                    "text": text,
+                    "error": error,
+                    "seconds": time.time() - start,
+                    "worker_id": worker_id,
+                    "stats": ocr_processor.last_stats,
+                },
+            )
+        )
+
+
+class OCRWorkerPool:
+    def __init__(
+        self,
+        model_id: str,
+        prompt: str,
+        num_workers: int = 2,
+        cores: Optional[List[int]] = None,
+        **processor_kwargs,
+    ):
+        """
+        A pool of OCR worker processes, each running its own PhiProcessor on a disjoint slice of the cores.
+        Workers pull image paths from a shared queue, so faster workers automatically take more images.
+        Workers load the weights memory-mapped (mmap_weights=True) in bfloat16 by default, so
+        all workers share one copy of the weights in the OS page cache.
+        Workers are pinned to their cores where os.sched_setaffinity exists (Linux); elsewhere, e.g. on
+        Windows and macOS, only their number of threads is limited to the size of their slice.
+
+        Parameters
+        ----------
+        model_id : str
+            The Phi-3-vision model identifier.
+        prompt : str
+            The OCR prompt.
+        num_workers : int, optional
+            The number of worker processes (default is 2).
+        cores : List[int], optional
+            The cores to divide over the workers (default is all cores available to this process).
+        **processor_kwargs
+            Additional keyword arguments for PhiProcessor, e.g. max_new_tokens or crop_policy.
+        """
+        processor_kwargs.setdefault("cpu_mode", "bfloat16")
+        processor_kwargs.setdefault("mmap_weights", True)
+        self.processor_kwargs = {"model_id": model_id, "prompt": prompt, **processor_kwargs}
+        self.core_slices = partition_cores(num_workers, cores)
+        # how often to check the workers are alive while waiting for a result
+        self.poll_seconds = 1.0
+
+        # spawn instead of fork: forking a process with running torch threads is unsafe
+        context = mp.get_context("spawn")
+        self.task_queue = context.Queue()
+        self.result_queue = context.Queue()
+        self.workers = [
+            context.Process(
+                target=_worker_main,
+                args=(
+                    worker_id,
+                    worker_cores,
+                    self.processor_kwargs,
+                    self.task_queue,
+                    self.result_queue,
+                ),
+                daemon=True,
+            )
+            for worker_id, worker_cores in enumerate(self.core_slices)
+        ]
+
+    def _get_message(self) -> Dict:
+        # poll instead of blocking, so a worker that died without a message raises instead of hanging
+        while True:
+            try:
+                kind, message = self.result_queue.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                for worker_id, worker in enumerate(self.workers):
+                    if not worker.is_alive():
+                        raise RuntimeError(
+                            f"Worker {worker_id} died with exit code {worker.exitcode}."
+                        )
+                continue
+            if kind == "error":
+                raise RuntimeError(
+                    f"Worker {message['worker_id']} failed to load the model:\n{message['error']}"
+                )
+            return message
+
+    def start(self) -> None:
+        """
+        Starts the workers and waits until every worker has loaded its model. Raises a RuntimeError
+        if a worker fails to load the model or dies; the other workers are then stopped.
+        """
+        for worker in self.workers:
+            worker.start()
+        try:
+            for _ in self.workers:
+                worker_id = self._get_message()["worker_id"]
+                print(f"Worker {worker_id} ready on cores {self.core_slices[worker_id]}")
+        except RuntimeError:
+            self.terminate()
+            raise
+
+    def map(self, image_paths: List[str]) -> Generator[Dict, None, None]:
+        """
+        Processes the images on the workers.
+
+        Parameters
+        ----------
+        image_paths : List[str]
+            The paths of the images to process.
+
+        Yields
+        ------
+        Dict
+            The result of every image, in order of completion, with the keys image_path, text, error,
+            seconds, worker_id and stats. A failed image has its error set; a worker that dies raises
+            a RuntimeError.
+        """
+        for image_path in image_paths:
+            self.task_queue.put(image_path)
+        for _ in image_paths:
+            yield self._get_message()
+
+    def close(self) -> None:
+        """
+        Stops the workers after they finish their current image.
+        """
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def terminate(self) -> None:
+        """
+        Stops the workers immediately, e.g. after one of them failed.
+        """
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    def __enter__(self) -> "OCRWorkerPool":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> None:
+        # after an error, the remaining workers may never get to the stop signal
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+def process_images_parallel(directory_path: str, pool: OCRWorkerPool) -> List[str]:
+    """
+    Runs OCR on all images in a directory with a worker pool and reports the throughput.
+
+    Parameters
+    ----------
+    directory_path : str
+        The directory containing .jpg, .jpeg or .png images.
+    pool : OCRWorkerPool
+        A started worker pool.
+
+    Returns
+    -------
+    List[str]
+        The OCR text of every image, in the order of the directory listing.
+    """
+    image_paths = [
+        os.path.join(directory_path, filename)
+        for filename in os.listdir(directory_path)
+        if filename.lower().endswith((".jpg", ".jpeg", ".png"))
+    ]
+    if not image_paths:
+        print(f"No images found in {directory_path}")
+        return []
+    texts = {}
+    start = time.time()
+    for result in pool.map(image_paths):
+        filename = os.path.basename(result["image_path"])
+        if result["error"] is not None:
+            print(f"Error processing image: {filename}")
+            print(result["error"])
+            continue
+        print(
+            f"Processed {filename} on worker {result['worker_id']} in {result['seconds']:.2f} seconds"
+        )
+        texts[result["image_path"]] = result["text"]
+    elapsed = time.time() - start
+
+    print(
+        f"\nProcessed {len(texts)} images with {len(pool.workers)} workers in {elapsed:.2f} seconds "
+        f"({len(texts) / max(elapsed, 1e-9) * 3600:.0f} images/hour)"
+    )
+    return [texts[image_path] for image_path in image_paths if image_path in texts]
+
+
+if __name__ == "__main__":
+    model_id = "microsoft/Phi-3-vision-128k-instruct"
+    prompt = (
+        "<|image_1|>\\Extract the complete literal text from the image using Optical Character Recognition. "
+        "Just give the complete text as your answer. "
+        "Do NOT provide a description or any additional information!"
+    )
+
+    directory_path = r"C:\Users\user\Documents\images"
+    with OCRWorkerPool(model_id, prompt, num_workers=4, max_new_tokens=5000) as pool:
+        results = process_images_parallel(directory_path, pool)
+    for result in results:
+        print(result)
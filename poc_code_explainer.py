@@ -1,17 +1,36 @@
 # poc_summary.py
 
 import asyncio
-import string
 from typing import AsyncGenerator
 from llm_invoke import LLM
+from stream_pipeline import coalesce_tokens
+from code_retrieval import load_or_build_retriever
 from get_code_content import (
     CodeContentOrganizer,
     extract_docs_type_hints_and_contents_of,
 )
 
 
+SYSTEM_PROMPT = (
+    "You are a helpful chatbot that answers questions about code. "
+    "Tasks: 1) Answer concisely and to the point. Use no more words than necessary. "
+    "Focus on key points and code essence. Describe important functions/classes. "
+    "Ensure clarity and structure. Include illustrative examples if present. "
+    "2) Avoid hallucination. Only use information from the given code."
+)
+
+
+def user_message(question: str, code_content: str, max_words: int) -> str:
+    return f"Answer in max {max_words} words: `{question}`\n\nCode:\n{code_content}"
+
+
 async def answer_question_with_code(
-    question: str, llm: LLM, code_content: str, max_words: int = 150, **model_kwargs
+    question: str,
+    llm: LLM,
+    code_content: str,
+    max_words: int = 150,
+    max_tokens: int = 1024,
+    **model_kwargs,
 ) -> AsyncGenerator[str, None]:
     """
     Answers a question about code using a language model.
@@ -26,57 +45,67 @@ async def answer_question_with_code(
         The code content to use for answering the question.
     max_words : int, optional
         The maximum number of words to use in the answer (default is 150).
+    max_tokens : int, optional
+        The maximum number of tokens of the answer (default is 1024).
     **model_kwargs
         Additional keyword arguments to pass to the language model. Examples: top_p, temperature, etc.
     """
-    prompt = (
-        "You are a helpful chatbot that answers questions about code. "
-        "Tasks: 1) Answer concisely and to the point. Use no more words than necessary. "
-        "Focus on key points and code essence. Describe important functions/classes. "
-        "Ensure clarity and structure. Include illustrative examples if present. "
-        "2) Avoid hallucination. Only use information from the given code."
-    )
-
     messages = [
-        {"role": "system", "content": prompt},
-        {
-            "role": "user",
-            "content": f"Answer in max {max_words} words: `{question}`\n\nCode:\n{code_content}",
-        },
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_message(question, code_content, max_words)},
     ]
 
-    buffer = ""
-    for content in llm.stream(messages, max_tokens=1024, **model_kwargs):
-        buffer += content
-        if set(content) & set(string.whitespace + string.punctuation):
-            yield buffer
-            buffer = ""
-
-    if buffer:
-        yield buffer
+    for part in coalesce_tokens(llm.stream(messages, max_tokens=max_tokens, **model_kwargs)):
+        yield part
 
 
-async def main(question: str, llm, code_content: str, max_words: int = 150) -> None:
+async def main(
+    question: str, llm, code_content: str, max_words: int = 150, max_tokens: int = 1024
+) -> None:
     print("Answer:", end="", flush=True)
-    async for part in answer_question_with_code(question, llm, code_content, max_words):
+    async for part in answer_question_with_code(question, llm, code_content, max_words, max_tokens):
         print(part, end="", flush=True)
 
 
 if __name__ == "__main__":
     root_dir = r".venv\Lib\site-packages\orpheus"
-    organizer = CodeContentOrganizer(root_dir, ["__pycache__"], ["test"])
+    # the index keeps the processed package between runs, so only changed files are processed again
+    organizer = CodeContentOrganizer(
+        root_dir, ["__pycache__"], ["test"], index_path="code_index.sqlite"
+    )
     model_path = r"model\phi-3-mini-128k-instruct.Q5_K_M.gguf"
     tokenizer_path = "microsoft/Phi-3-mini-128k-instruct"
-    code_content = organizer.get_code_content()
-    code_content = organizer.optimize_content_length(code_content, max_lines=50)
-    code_content = extract_docs_type_hints_and_contents_of(
-        code_content, organizer.separator
-    ) 
+    question = "Make a top 10 of the most important functions in the code."
+    max_words = 500
+    answer_tokens = 1024
+
+    use_retrieval = True
+    # only the code chunks relevant to the question are sent, which fits in a much smaller context
+    context_length = 16000 if use_retrieval else 128000
     llm = LLM(
         tokenizer_path=tokenizer_path,
         model_path=model_path,
-        context_length=128000,
+        context_length=context_length,
     )
+    if use_retrieval:
+        tree_lines, file_paths = organizer.scan()
+        retriever = load_or_build_retriever(organizer, "code_retrieval_index", file_paths)
+        tree = "\n".join(organizer.generate_directory_tree(tree_lines))
+        # code tokenizes much denser than prose, so the budget is counted with the model's own tokenizer;
+        # the answer, the instructions and a few tokens of chat template per message stay free
+        count_tokens = llm.ctx.__count_tokens__
+        prompt_tokens = count_tokens(SYSTEM_PROMPT) + count_tokens(user_message(question, "", max_words)) + 16
+        code_content = retriever.build_context(
+            question,
+            tree,
+            top_k=30,
+            max_tokens=context_length - answer_tokens - prompt_tokens,
+            count_tokens=count_tokens,
+        )
+    else:
+        code_content = organizer.get_budgeted_content(max_tokens=100000)
+        code_content = extract_docs_type_hints_and_contents_of(
+            code_content, organizer.separator
+        )
 
-    question = "Make a top 10 of the most important functions in the code."
-    asyncio.run(main(question, llm, code_content, max_words=500))
+    asyncio.run(main(question, llm, code_content, max_words=max_words, max_tokens=answer_tokens))
@@ -1,26 +1,71 @@
 import asyncio
-import string
+import os
+import sqlite3
 import aioconsole
 from llm_invoke import LLM
+from stream_pipeline import coalesce_tokens
 from configs import MODEL_PATH
-import difflib
+from function_router import FunctionRouter
+from tool_executor import IO_BOUND, Tool, ToolExecutor
 
 llm = LLM(tokenizer_path="microsoft/Phi-3-mini-4k-instruct", model_path="./model/fietje-3-mini-4k-instruct-Q5_K_M.gguf")
 
+# lokale SQLite-database als vervanger van de echte database
+DATABASE_PATH = "./example.sqlite"
+
+def create_example_database(database_path: str):
+    if os.path.exists(database_path):
+        return
+    with sqlite3.connect(database_path) as connection:
+        connection.execute("CREATE TABLE leveringen (leverancier TEXT, land TEXT, kilo INTEGER)")
+        connection.executemany(
+            "INSERT INTO leveringen VALUES (?, ?, ?)",
+            [("Pommes du Sud", "Frankrijk", 12000), ("Boer Jansen", "Nederland", 3500), ("Apfelhof", "Duitsland", 8000)],
+        )
+
 async def call_hello_world():
-    yield "call_hello_world()"
+    return "call_hello_world()"
+
+def execute_sql(query: str = "SELECT * FROM leveringen", database_path: str = DATABASE_PATH):
+    # alleen-lezen, zodat een gegenereerde query de database niet kan wijzigen
+    with sqlite3.connect(f"file:{database_path}?mode=ro", uri=True) as connection:
+        cursor = connection.execute(query)
+        columns = [column[0] for column in cursor.description]
+        rows = cursor.fetchall()
+    return "\n".join([" | ".join(columns)] + [" | ".join(str(value) for value in row) for row in rows])
 
-async def execute_sql():
-    yield "execute_sql()"
+create_example_database(DATABASE_PATH)
 
 function_map = {
-    "print_hello": call_hello_world,
-    "execute_sql": execute_sql,
+    "print_hello": Tool(call_hello_world, pure=True),
+    "execute_sql": Tool(execute_sql, kind=IO_BOUND, timeout=10, max_concurrency=4),
 }
 
-def get_closest_function(query, functions):
-    closest_match = difflib.get_close_matches(query, functions, n=1, cutoff=0.6)
-    return closest_match[0] if closest_match else None
+# tools draaien naast het genereren: coroutines op de event loop, blokkerende I/O in een threadpool
+executor = ToolExecutor(function_map)
+
+# beschrijvingen en voorbeeldvragen per functie, waarop de router vragen matcht
+function_descriptions = {
+    "print_hello": {
+        "description": "Print hello world, zeg hallo tegen de gebruiker.",
+        "examples": [
+            "Roep de functie aan om hallo te zeggen.",
+            "Print hello world.",
+            "Zeg eens hallo.",
+        ],
+    },
+    "execute_sql": {
+        "description": "Voer een SQL-query uit op de database.",
+        "examples": [
+            "Roep de functie aan om de SQL-query uit te voeren.",
+            "Voer de query uit op de database.",
+            "Draai de SQL.",
+        ],
+    },
+}
+
+# de index wordt eenmalig opgebouwd, routeren kost daarna minder dan een milliseconde per vraag
+router = FunctionRouter(function_descriptions)
 
 async def ask(question: str):
     prompt = (
@@ -38,22 +83,19 @@ async def ask(question: str):
         {"role": "user", "content": f"Vraag: {question}"},
     ]
 
-    # Controleer of de vraag een functie-aanroep bevat of iets dat erop lijkt
-    closest_function = get_closest_function(question, function_map.keys())
+    # Controleer of de vraag een functie-aanroep bevat of iets dat erop lijkt; alleen bij twijfel
+    # kiest de LLM, beperkt door een grammatica tot een functienaam of "none"
+    closest_function, ambiguous = router.route(question)
+    if ambiguous:
+        closest_function = router.choose_function_with_llm(llm, question)
     if closest_function:
-        async for message in function_map[closest_function]():
-            yield message
+        # meerdere tool-aanroepen draaien parallel, een beurt duurt zo lang als de traagste tool
+        for call in await executor.call_many([(closest_function, {})]):
+            yield call["result"] if call["error"] is None else f"Fout in {call['name']}: {call['error']}"
         return
 
-    buffer = ""
-    for content in llm.stream(messages, max_tokens=512):
-        buffer += content
-        if any(c in string.whitespace + string.punctuation for c in content):
-            yield buffer
-            buffer = ""
-
-    if buffer:
-        yield buffer
+    for part in coalesce_tokens(llm.stream(messages, max_tokens=512)):
+        yield part
 
 async def interactive_chatbot():
     print("Interactieve Chatbot. Typ je vraag en druk op Enter. Typ 'exit' of 'quit' om af te sluiten.")
@@ -70,4 +112,7 @@ async def interactive_chatbot():
         print()  # Voor een nieuwe regel na het antwoord van de chatbot
 
 if __name__ == "__main__":
-    asyncio.run(interactive_chatbot())
+    try:
+        asyncio.run(interactive_chatbot())
+    finally:
+        executor.close()
@@ -2,14 +2,25 @@ import time
 import torch
 from PIL import Image
 from transformers import (
+    AutoConfig,
     AutoModelForCausalLM,
     AutoProcessor,
     BitsAndBytesConfig,
     TextIteratorStreamer,
 )
 from threading import Thread
+import glob
+import json
+import mmap
 import os
-from typing import List, Optional
+from typing import Dict, List, Optional
+from ocr_image_analysis import AdaptiveCropPolicy, ImageTriage
+from generation_stopping import DegenerationGuard, summarize_stopping
+from stream_pipeline import ConsoleSink, StreamPipeline
+from tracing import span, traced
+
+
+CPU_MODES = ("float32", "bfloat16", "int8")
 
 
 def is_flash_attention_available() -> bool:
@@ -21,6 +32,92 @@ def is_flash_attention_available() -> bool:
         return False
 
 
+SAFETENSORS_DTYPES = {
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def mmap_safetensors(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Maps a .safetensors file into memory and returns its tensors as zero-copy views.
+    The file is mapped copy-on-write, so processes mapping the same file share the pages
+    of the OS page cache instead of each holding a private copy of the weights.
+
+    Parameters:
+    - path: The path to the .safetensors file.
+
+    Returns:
+    - The tensors by name.
+    """
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    header_size = int.from_bytes(buffer[:8], "little")
+    header = json.loads(buffer[8 : 8 + header_size])
+    header.pop("__metadata__", None)
+
+    tensors = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        count = (end - start) // torch.empty((), dtype=dtype).element_size()
+        tensor = torch.frombuffer(
+            buffer, dtype=dtype, count=count, offset=8 + header_size + start
+        )
+        tensors[name] = tensor.reshape(info["shape"])
+    return tensors
+
+
+def load_model_from_mmap(model_id: str, torch_dtype: torch.dtype, attn_implementation: str):
+    """
+    Loads a model on CPU with its weights pointing directly into memory-mapped safetensors files.
+    Only when torch_dtype equals the dtype stored in the files the weights stay zero-copy,
+    for other dtypes the weights are converted into private memory.
+
+    Parameters:
+    - model_id: The model identifier or a local directory containing the model.
+    - torch_dtype: The dtype of the model weights.
+    - attn_implementation: The attention implementation of the model.
+
+    Returns:
+    - The model in evaluation mode.
+    """
+    from huggingface_hub import snapshot_download
+    from transformers.modeling_utils import no_init_weights
+
+    model_dir = (
+        model_id
+        if os.path.isdir(model_id)
+        else snapshot_download(model_id, allow_patterns=["*.json", "*.py", "*.safetensors"])
+    )
+    config = AutoConfig.from_pretrained(model_dir, trust_remote_code=True)
+
+    # skipping the weight initialization keeps the placeholder weights untouched, so they never become resident
+    with no_init_weights():
+        model = AutoModelForCausalLM.from_config(
+            config,
+            trust_remote_code=True,
+            torch_dtype=torch_dtype,
+            attn_implementation=attn_implementation,
+        )
+
+    state_dict = {}
+    for path in sorted(glob.glob(os.path.join(model_dir, "*.safetensors"))):
+        for name, tensor in mmap_safetensors(path).items():
+            state_dict[name] = tensor if tensor.dtype == torch_dtype else tensor.to(torch_dtype)
+
+    missing, _ = model.load_state_dict(state_dict, strict=False, assign=True)
+    if missing:
+        raise ValueError(f"Weights missing in safetensors files of {model_id}: {missing}")
+    return model.eval()
+
+
 class PhiProcessor:
     def __init__(
         self,
@@ -30,6 +127,12 @@ class PhiProcessor:
         max_new_tokens: int = 5000,
         temperature: float = 0.0,
         quantization_bits: Optional[int] = None,
+        cpu_mode: str = "float32",
+        crop_policy: Optional[AdaptiveCropPolicy] = None,
+        num_threads: Optional[int] = None,
+        mmap_weights: bool = False,
+        stream_output: bool = True,
+        degeneration_guard: Optional[DegenerationGuard] = None,
     ):
         """
         A class specially designed as a wrapper for Microsoft Phi-3 based models.
@@ -41,10 +144,22 @@ class PhiProcessor:
         - max_new_tokens: The maximum number of tokens to generate in the response.
         - temperature: The temperature to be used for sampling. If 0.0, greedy decoding will be used.
         - quantization_bits: The number of bits to use for quantization. If None, no quantization will be used. Not applicable for CPU.
+        - cpu_mode: The weight format used on CPU. One of "float32", "bfloat16" or "int8" (float32 weights with
+          dynamic int8 quantization of all linear layers). Ignored on GPU, where quantization_bits applies.
+        - crop_policy: Chooses the number of image crops per image. If None, the processor default is used for every image.
+        - num_threads: The number of intra-op threads on CPU. If None, all cores are used.
+        - mmap_weights: Load the weights on CPU as views into the memory-mapped safetensors files, so multiple
+          processes share one copy of the weights. Only zero-copy with cpu_mode "bfloat16", the dtype of the files.
+        - stream_output: Print the generated text to the console while generating.
+        - degeneration_guard: Stops repeating, over-budget or timed out generations early and marks their
+          results as truncated in last_stats, as it does results cut off at max_new_tokens (stop_reason "length").
+          If None, generation only stops at EOS or max_new_tokens.
         """
 
         if quantization_bits is not None and quantization_bits not in [4, 8]:
             raise ValueError("Quantization bits must be either None, 4 or 8.")
+        if cpu_mode not in CPU_MODES:
+            raise ValueError(f"CPU mode must be one of {CPU_MODES}.")
 
         self.model_id = model_id
         self.prompt = prompt
@@ -54,21 +169,43 @@ class PhiProcessor:
         self.processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
         self.max_new_tokens = max_new_tokens
         self.temperature = temperature
+        self.cpu_mode = cpu_mode
+        self.crop_policy = crop_policy
+        self.stream_output = stream_output
+        self.degeneration_guard = degeneration_guard
+        self.last_stats = {}
 
         self._attention_implementation = (
             "flash" if is_flash_attention_available() else "eager"
         )
 
         if self.device == "cpu":
-            torch.set_num_threads(os.cpu_count())
-            torch.set_num_interop_threads(os.cpu_count())
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_id,
-                device_map={"": "cpu"},
-                trust_remote_code=True,
-                torch_dtype=torch.float32,
-                _attn_implementation=self._attention_implementation,
-            )
+            # generation runs a single graph, so inter-op parallelism would only compete
+            # with the intra-op threads for the same cores
+            torch.set_num_threads(num_threads or os.cpu_count())
+            try:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                # can only be set once per process, before any parallel work has started
+                pass
+            torch_dtype = torch.bfloat16 if cpu_mode == "bfloat16" else torch.float32
+            if mmap_weights:
+                self.model = load_model_from_mmap(
+                    model_id, torch_dtype, self._attention_implementation
+                )
+            else:
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    model_id,
+                    device_map={"": "cpu"},
+                    trust_remote_code=True,
+                    torch_dtype=torch_dtype,
+                    _attn_implementation=self._attention_implementation,
+                )
+            if cpu_mode == "int8":
+                # dynamic quantization only supports float32 linear layers, activations stay float32
+                self.model = torch.ao.quantization.quantize_dynamic(
+                    self.model, {torch.nn.Linear}, dtype=torch.qint8
+                )
         else:
             quantization_config = None
             if quantization_bits == 4:
@@ -95,71 +232,163 @@ class PhiProcessor:
                 _attn_implementation=self._attention_implementation,
             )
 
+    def model_size_mb(self) -> float:
+        """
+        Returns the in-memory size of the model weights in MB, including packed int8 weights,
+        computed from the tensor shapes without copying any weights.
+        """
+        tensors = list(self.model.parameters()) + list(self.model.buffers())
+        # dynamically quantized linear layers keep their int8 weights in packed params, not in parameters
+        for module in self.model.modules():
+            if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+                tensors.extend(tensor for tensor in module._weight_bias() if tensor is not None)
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors) / 1024**2
+
+    @traced("ocr.prepare_inputs")
     def prepare_inputs(self, image: Image.Image, prompt: str):
+        self.last_stats = {"image_size": image.size}
+        if self.crop_policy is not None:
+            self.processor.image_processor.num_crops = self.crop_policy.choose_num_crops(image)
+        self.last_stats["num_crops"] = self.processor.image_processor.num_crops
+
         messages = [{"role": "user", "content": prompt}]
         prompt_text = self.processor.tokenizer.apply_chat_template(
             messages, tokenize=False, add_generation_prompt=True
         )
-        inputs = self.processor(prompt_text, [image], return_tensors="pt").to(
-            self.device
-        )
+        with span("ocr.processor", num_crops=self.last_stats["num_crops"]):
+            inputs = self.processor(prompt_text, [image], return_tensors="pt").to(
+                self.device
+            )
+        if self.device == "cpu" and self.cpu_mode == "bfloat16":
+            # only casts floating point tensors such as pixel_values, input ids stay intact
+            inputs = inputs.to(torch.bfloat16)
+        # image tokens are represented by negative placeholder ids in the prompt
+        self.last_stats["image_tokens"] = int((inputs["input_ids"] < 0).sum())
         return inputs
 
+    @traced("ocr.generate_response")
     @torch.inference_mode()
-    def generate_response(self, inputs: dict) -> str:
+    def generate_response(self, inputs: dict, max_new_tokens: Optional[int] = None) -> str:
         streamer = TextIteratorStreamer(
             self.processor.tokenizer, skip_prompt=True, skip_special_tokens=True
         )
+        max_new_tokens = max_new_tokens or self.max_new_tokens
         generation_args = {
-            "max_new_tokens": self.max_new_tokens,
+            "max_new_tokens": max_new_tokens,
             "streamer": streamer,
             "eos_token_id": self.processor.tokenizer.eos_token_id,
         }
 
+        stopping_criteria = None
+        if self.degeneration_guard is not None:
+            stopping_criteria = self.degeneration_guard.create(
+                inputs["input_ids"].shape[1],
+                self.last_stats.get("image_size", (0, 0)),
+                max_new_tokens,
+            )
+            generation_args["stopping_criteria"] = stopping_criteria
+
         if self.temperature > 0.0:
             generation_args["temperature"] = self.temperature
             generation_args["do_sample"] = True
 
         thread = Thread(
-            target=self.model.generate, kwargs={**inputs, **generation_args}
+            target=traced("ocr.model_generate")(self.model.generate),
+            kwargs={**inputs, **generation_args},
         )
+        start = time.time()
         thread.start()
 
-        generated_text = ""
-        for new_text in streamer:
-            print(new_text, end="", flush=True)
-            generated_text += new_text
-
+        pipeline = StreamPipeline([ConsoleSink()] if self.stream_output else [])
+        generated_text = pipeline.run(streamer)
         thread.join()
-        print()
+
+        seconds = time.time() - start
+        self.last_stats["seconds"] = seconds
+        if stopping_criteria is not None:
+            summary = summarize_stopping(
+                stopping_criteria, max_new_tokens, self.processor.tokenizer.eos_token_id
+            )
+            seconds_per_token = seconds / max(summary["new_tokens"], 1)
+            summary["seconds_saved"] = summary["tokens_saved"] * seconds_per_token
+            self.last_stats.update(summary)
+            if summary["truncated"]:
+                print(f"[truncated: {summary['stop_reason']} after {summary['new_tokens']} tokens]")
         return generated_text
 
-    def process_input_data(self, input_data) -> str:
+    def process_input_data(self, input_data, max_new_tokens: Optional[int] = None) -> str:
         inputs = self.prepare_inputs(input_data, self.prompt)
-        return self.generate_response(inputs)
+        return self.generate_response(inputs, max_new_tokens)
 
 
 def process_images_from_directory(
-    directory_path: str, ocr_processor: PhiProcessor
+    directory_path: str,
+    ocr_processor: PhiProcessor,
+    triage: Optional[ImageTriage] = None,
 ) -> List[str]:
+    """
+    Runs OCR on all images in a directory.
+
+    Parameters:
+    - directory_path: The directory containing .jpg, .jpeg or .png images.
+    - ocr_processor: The PhiProcessor used for OCR.
+    - triage: If given, images classified as containing no text are skipped and images with sparse text
+      are generated with a smaller token budget.
+    """
     results = []
+    total_image_tokens = 0
+    skipped = 0
+    truncated = 0
+    cut_off = 0
+    tokens_saved = 0
+    seconds_saved = 0.0
     for filename in os.listdir(directory_path):
         try:
             if filename.lower().endswith((".jpg", ".jpeg", ".png")):
                 image_path = os.path.join(directory_path, filename)
                 with Image.open(image_path) as image:
+                    max_new_tokens = None
+                    if triage is not None:
+                        decision, stats = triage.classify(image)
+                        triage.log(filename, decision, stats)
+                        if decision == ImageTriage.NO_TEXT:
+                            skipped += 1
+                            continue
+                        if decision == ImageTriage.SPARSE:
+                            max_new_tokens = triage.sparse_max_new_tokens
+
                     start = time.time()
                     print(f"\nProcessing image: {filename}")
                     print("-" * 50)
-                    result = ocr_processor.process_input_data(image)
+                    result = ocr_processor.process_input_data(image, max_new_tokens)
                     end = time.time()
                 print("-" * 50)
                 print(f"Processed in {end - start:.2f} seconds")
+                image_tokens = ocr_processor.last_stats.get("image_tokens", 0)
+                print(
+                    f"Image tokens: {image_tokens} "
+                    f"({ocr_processor.last_stats.get('num_crops')} crops)"
+                )
+                total_image_tokens += image_tokens
+                if ocr_processor.last_stats.get("stop_reason") == "length":
+                    cut_off += 1
+                elif ocr_processor.last_stats.get("truncated"):
+                    truncated += 1
+                    tokens_saved += ocr_processor.last_stats["tokens_saved"]
+                    seconds_saved += ocr_processor.last_stats["seconds_saved"]
                 results.append(result)
         except Exception as e:
             print(f"Error processing image: {filename}")
             print(e)
 
+    print(f"\nTotal image tokens: {total_image_tokens} for {len(results)} images")
+    if triage is not None:
+        print(f"Skipped {skipped} images without text")
+    if ocr_processor.degeneration_guard is not None:
+        print(
+            f"Truncated {truncated} generations, saving ~{tokens_saved} tokens "
+            f"and ~{seconds_saved:.0f} seconds; {cut_off} generations ran into max_new_tokens"
+        )
     return results
 
 
@@ -174,10 +403,17 @@ if __name__ == "__main__":
         "Do NOT provide a description or any additional information!"
     )
     ocr_processor = PhiProcessor(
-        model_id, prompt, device="cuda", max_new_tokens=5000, quantization_bits=8
+        model_id,
+        prompt,
+        device="cuda",
+        max_new_tokens=5000,
+        quantization_bits=8,
+        crop_policy=AdaptiveCropPolicy(min_crops=1, max_crops=16, max_image_tokens=2500),
+        degeneration_guard=DegenerationGuard(timeout=300),
     )
 
     directory_path = r"C:\Users\user\Documents\images"
-    results = process_images_from_directory(directory_path, ocr_processor)
+    triage = ImageTriage(log_path=os.path.join(directory_path, "triage_log.jsonl"))
+    results = process_images_from_directory(directory_path, ocr_processor, triage)
     for result in results:
         print(result)
@@ -0,0 +1,139 @@
+# poc_ocr_cpu_benchmark.py
+
+import difflib
+import gc
+import os
+import time
+from typing import Dict, List
+from PIL import Image
+from poc_ocr2 import PhiProcessor, CPU_MODES
+
+
+def load_fixture_images(directory_path: str) -> Dict[str, Image.Image]:
+    """
+    Loads all images of the fixture set into memory, so file IO is not part of the timings.
+
+    Parameters
+    ----------
+    directory_path : str
+        Directory containing the fixture images.
+
+    Returns
+    -------
+    Dict[str, Image.Image]
+        The images by filename.
+    """
+    images = {}
+    for filename in sorted(os.listdir(directory_path)):
+        if filename.lower().endswith((".jpg", ".jpeg", ".png")):
+            with Image.open(os.path.join(directory_path, filename)) as image:
+                images[filename] = image.convert("RGB")
+    return images
+
+
+def text_similarity(reference: str, candidate: str) -> float:
+    """
+    Returns the character level similarity (0.0 - 1.0) between the reference and candidate text.
+    """
+    return difflib.SequenceMatcher(None, reference, candidate, autojunk=False).ratio()
+
+
+def benchmark_cpu_modes(
+    model_id: str,
+    prompt: str,
+    images: Dict[str, Image.Image],
+    modes: List[str] = list(CPU_MODES),
+    max_new_tokens: int = 1000,
+) -> List[Dict]:
+    """
+    Runs the fixture images through PhiProcessor for every CPU mode and compares speed, memory and
+    output against the float32 reference.
+
+    Parameters
+    ----------
+    model_id : str
+        The Phi-3-vision model identifier.
+    prompt : str
+        The OCR prompt.
+    images : Dict[str, Image.Image]
+        The fixture images by filename.
+    modes : List[str], optional
+        The CPU modes to compare (default is all modes). "float32" is always run first as reference.
+    max_new_tokens : int, optional
+        The maximum number of tokens generated per image (default is 1000).
+
+    Returns
+    -------
+    List[Dict]
+        One report per mode with load time, model size, seconds per image and mean similarity to float32.
+    """
+    modes = ["float32"] + [mode for mode in modes if mode != "float32"]
+    reference_outputs = {}
+    reports = []
+
+    for mode in modes:
+        start = time.time()
+        ocr_processor = PhiProcessor(
+            model_id, prompt, device="cpu", max_new_tokens=max_new_tokens, cpu_mode=mode
+        )
+        load_time = time.time() - start
+        size_mb = ocr_processor.model_size_mb()
+
+        outputs = {}
+        start = time.time()
+        for filename, image in images.items():
+            outputs[filename] = ocr_processor.process_input_data(image)
+        seconds_per_image = (time.time() - start) / max(len(images), 1)
+
+        if mode == "float32":
+            reference_outputs = outputs
+        similarities = [
+            text_similarity(reference_outputs[filename], output)
+            for filename, output in outputs.items()
+        ]
+        reports.append(
+            {
+                "mode": mode,
+                "load_time": load_time,
+                "size_mb": size_mb,
+                "seconds_per_image": seconds_per_image,
+                "similarity": sum(similarities) / max(len(similarities), 1),
+            }
+        )
+
+        del ocr_processor
+        gc.collect()
+
+    return reports
+
+
+def print_report(reports: List[Dict]) -> None:
+    """
+    Prints the benchmark reports, relative to the float32 reference.
+    """
+    reference = reports[0]
+    print(f"{'mode':<10}{'load (s)':>10}{'size (MB)':>12}{'memory':>9}{'s/image':>10}{'speedup':>9}{'similarity':>12}")
+    for report in reports:
+        print(
+            f"{report['mode']:<10}"
+            f"{report['load_time']:>10.1f}"
+            f"{report['size_mb']:>12.0f}"
+            f"{report['size_mb'] / reference['size_mb']:>8.0%} "
+            f"{report['seconds_per_image']:>10.2f}"
+            f"{reference['seconds_per_image'] / report['seconds_per_image']:>8.2f}x"
+            f"{report['similarity']:>12.1%}"
+        )
+
+
+if __name__ == "__main__":
+    model_id = "microsoft/Phi-3-vision-128k-instruct"
+    prompt = (
+        "<|image_1|>\\Extract the complete literal text from the image using Optical Character Recognition. "
+        "Just give the complete text as your answer. "
+        "Do NOT provide a description or any additional information!"
+    )
+
+    fixture_path = r"C:\Users\user\Documents\images\fixtures"
+    images = load_fixture_images(fixture_path)
+    reports = benchmark_cpu_modes(model_id, prompt, images)
+    print_report(reports)
@@ -0,0 +1,114 @@
+# poc_speculative_benchmark.py
+
+import difflib
+from typing import Dict, List
+from llm_invoke import LLM
+
+
+def benchmark_speculative(
+    llm: LLM, prompts: Dict[str, List[Dict[str, str]]], max_tokens: int = 256, repeats: int = 1
+) -> List[Dict]:
+    """
+    Generates every prompt greedily with plain and with speculative decoding on the same loaded model,
+    and compares tokens per second, acceptance rate and output.
+
+    Parameters
+    ----------
+    llm : LLM
+        A model created with a speculative mode.
+    prompts : Dict[str, List[Dict[str, str]]]
+        The messages of every prompt by name.
+    max_tokens : int, optional
+        The maximum number of generated tokens per prompt (default is 256).
+    repeats : int, optional
+        The number of runs per prompt and path, the fastest run counts (default is 1).
+
+    Returns
+    -------
+    List[Dict]
+        One report per prompt with the tokens per second of both paths, the speedup, the acceptance rate
+        and the similarity of the speculative output to the plain output (1.0 for greedy decoding).
+    """
+    if llm.draft_model is None:
+        raise ValueError("The model was created without a speculative mode.")
+
+    reports = []
+    for name, messages in prompts.items():
+        runs = {}
+        for speculative in (False, True):
+            llm.use_speculative(speculative)
+            best = None
+            for _ in range(repeats):
+                output = "".join(llm.stream(messages, max_tokens=max_tokens, temperature=0.0))
+                if best is None or llm.last_stats["tokens_per_second"] > best[1]["tokens_per_second"]:
+                    best = (output, dict(llm.last_stats))
+            runs[speculative] = best
+
+        (plain_output, plain), (speculative_output, speculative) = runs[False], runs[True]
+        reports.append(
+            {
+                "prompt": name,
+                "tokens": speculative["tokens"],
+                "plain_tokens_per_second": plain["tokens_per_second"],
+                "speculative_tokens_per_second": speculative["tokens_per_second"],
+                "speedup": speculative["tokens_per_second"] / max(plain["tokens_per_second"], 1e-9),
+                "acceptance_rate": speculative["acceptance_rate"],
+                "tokens_per_step": speculative["tokens"] / max(speculative["verification_steps"] + 1, 1),
+                "similarity": difflib.SequenceMatcher(
+                    None, plain_output, speculative_output, autojunk=False
+                ).ratio(),
+            }
+        )
+
+    llm.use_speculative(True)
+    return reports
+
+
+def print_report(reports: List[Dict]) -> None:
+    """
+    Prints the benchmark reports.
+    """
+    print(f"{'prompt':<16}{'tokens':>8}{'plain tok/s':>13}{'spec tok/s':>12}{'speedup':>9}{'accepted':>10}{'tok/step':>10}{'similarity':>12}")
+    for report in reports:
+        print(
+            f"{report['prompt']:<16}"
+            f"{report['tokens']:>8}"
+            f"{report['plain_tokens_per_second']:>13.1f}"
+            f"{report['speculative_tokens_per_second']:>12.1f}"
+            f"{report['speedup']:>8.2f}x"
+            f"{report['acceptance_rate']:>10.1%}"
+            f"{report['tokens_per_step']:>10.2f}"
+            f"{report['similarity']:>12.1%}"
+        )
+
+
+if __name__ == "__main__":
+    llm = LLM(
+        tokenizer_path="microsoft/Phi-3-mini-4k-instruct",
+        model_path="./model/fietje-3-mini-4k-instruct-Q5_K_M.gguf",
+        speculative="prompt_lookup",
+        num_pred_tokens=10,
+    )
+
+    transcript = (
+        "spreker 1:\nGoedemorgen, iedereen. Laten we beginnen met de vergadering over de invoer van appels. "
+        "Henk, kun je ons een update geven over de huidige stand van zaken?\n\n"
+        "spreker 2:\nGoedemorgen Jan, zeker. Op dit moment hebben we een overeenkomst met een leverancier uit Frankrijk. "
+        "Raggamuffin, wat is jouw mening over de kwaliteit van de appels die we tot nu toe hebben ontvangen?\n\n"
+        "spreker 3:\nGoedemorgen Henk en Jan. De kwaliteit van de appels is over het algemeen goed, maar er zijn "
+        "een paar partijen geweest die niet aan onze standaard voldeden."
+    )
+    with open("llm_invoke.py", "r", encoding="utf-8") as f:
+        code = f.read()
+
+    prompts = {
+        "summary": [
+            {"role": "system", "content": "Vat het transcript kort samen en noem de sprekers bij naam."},
+            {"role": "user", "content": transcript},
+        ],
+        "code_explainer": [
+            {"role": "system", "content": "Leg de code uit en noem de belangrijkste functies en parameters bij naam."},
+            {"role": "user", "content": code},
+        ],
+    }
+    print_report(benchmark_speculative(llm, prompts))
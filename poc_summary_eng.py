@@ -1,9 +1,9 @@
 # poc_summary.py
 
 import asyncio
-import string
 from typing import AsyncGenerator
 from llm_invoke import LLM
+from stream_pipeline import coalesce_tokens
 
 llm = LLM(
     tokenizer_path="microsoft/Phi-3-mini-128k-instruct",
@@ -105,15 +105,8 @@ async def summarize_text(max_words: int = 150) -> AsyncGenerator[str, None]:
         },
     ]
 
-    buffer = ""
-    for content in llm.stream(messages, max_tokens=512):
-        buffer += content
-        if any(c in string.whitespace + string.punctuation for c in content):
-            yield buffer
-            buffer = ""
-
-    if buffer:
-        yield buffer
+    for part in coalesce_tokens(llm.stream(messages, max_tokens=512)):
+        yield part
 
 async def main(max_words: int = 150) -> None:
     """
@@ -0,0 +1,127 @@
+# speculative_decoding.py
+
+from typing import Dict
+import numpy as np
+import numpy.typing as npt
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+
+PROMPT_LOOKUP = "prompt_lookup"
+DRAFT_MODEL = "draft_model"
+SPECULATIVE_MODES = (PROMPT_LOOKUP, DRAFT_MODEL)
+
+
+class GGUFDraftModel(LlamaDraftModel):
+    def __init__(
+        self, model_path: str, num_pred_tokens: int = 4, context_length: int = 2560, n_threads: int = 8
+    ):
+        """
+        Drafts tokens greedily with a smaller GGUF model. The draft model must share the tokenizer
+        (vocabulary) of the main model, e.g. a smaller quantization or size of the same family.
+
+        Parameters
+        ----------
+        model_path : str
+            The path to the draft model.
+        num_pred_tokens : int, optional
+            The number of tokens drafted per verification step (default is 4).
+        context_length : int, optional
+            The context length, at least that of the main model (default is 2560).
+        n_threads : int, optional
+            The number of threads of the draft model (default is 8).
+        """
+        self.num_pred_tokens = num_pred_tokens
+        self.model = Llama(
+            model_path=model_path, n_ctx=context_length, n_threads=n_threads, n_gpu_layers=0, verbose=False
+        )
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs) -> npt.NDArray[np.intc]:
+        draft = []
+        # generate reuses the longest common prefix with the previous call from the KV cache,
+        # so every step only evaluates the tokens accepted since the last draft
+        for token in self.model.generate(input_ids.tolist(), top_k=1, temp=0.0, reset=True):
+            draft.append(token)
+            if len(draft) >= self.num_pred_tokens or token == self.model.token_eos():
+                break
+        return np.asarray(draft, dtype=np.intc)
+
+
+class CountingDraftModel(LlamaDraftModel):
+    def __init__(self, draft_model: LlamaDraftModel):
+        """
+        Wraps a draft model to count verification steps, drafted tokens and accepted tokens. A draft is
+        verified in the forward pass after it, so the next call sees the sequence it was verified against:
+        the accepted tokens are the prefix of the draft that the sequence continues with.
+        """
+        self.draft_model = draft_model
+        self.reset()
+
+    def reset(self) -> None:
+        self.steps = 0
+        self.drafted = 0
+        self.accepted = 0
+        self._last_length = 0
+        self._last_draft = None
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs) -> npt.NDArray[np.intc]:
+        if self._last_draft is not None:
+            verified = input_ids[self._last_length : self._last_length + len(self._last_draft)]
+            mismatches = np.flatnonzero(verified != self._last_draft[: len(verified)])
+            self.accepted += int(mismatches[0]) if len(mismatches) else len(verified)
+            self.drafted += len(self._last_draft)
+        draft = self.draft_model(input_ids, **kwargs)
+        self.steps += 1
+        self._last_length = len(input_ids)
+        self._last_draft = np.asarray(draft)
+        return draft
+
+    def summary(self) -> Dict[str, float]:
+        """
+        Returns the verification steps, and the drafted and accepted tokens with the acceptance rate of
+        the generation since the last reset. The draft of the last step is left out, since the generation
+        may have stopped before verifying it.
+        """
+        return {
+            "verification_steps": self.steps,
+            "drafted_tokens": self.drafted,
+            "accepted_tokens": self.accepted,
+            "acceptance_rate": self.accepted / self.drafted if self.drafted else 0.0,
+        }
+
+
+def create_draft_model(mode: str, **kwargs) -> CountingDraftModel:
+    """
+    Creates the draft model of a speculative decoding mode.
+
+    Parameters
+    ----------
+    mode : str
+        PROMPT_LOOKUP drafts by matching the last n-gram of the sequence against the prompt and copying
+        what followed it, which is free and works well when the output copies from the input (names, phrases,
+        identifiers). DRAFT_MODEL drafts with a smaller GGUF model given by draft_model_path.
+    **kwargs
+        num_pred_tokens, max_ngram_size (PROMPT_LOOKUP), draft_model_path, context_length and n_threads (DRAFT_MODEL).
+
+    Returns
+    -------
+    CountingDraftModel
+        The draft model, wrapped to measure its acceptance rate.
+    """
+    if mode == PROMPT_LOOKUP:
+        draft_model = LlamaPromptLookupDecoding(
+            max_ngram_size=kwargs.get("max_ngram_size", 2),
+            num_pred_tokens=kwargs.get("num_pred_tokens", 10),
+        )
+    elif mode == DRAFT_MODEL:
+        if kwargs.get("draft_model_path") is None:
+            raise ValueError(f"Speculative mode {DRAFT_MODEL} requires a draft_model_path.")
+        draft_model = GGUFDraftModel(
+            kwargs["draft_model_path"],
+            num_pred_tokens=kwargs.get("num_pred_tokens", 4),
+            context_length=kwargs.get("context_length", 2560),
+            n_threads=kwargs.get("n_threads", 8),
+        )
+    else:
+        raise ValueError(f"Invalid speculative mode: {mode}. Expected one of {SPECULATIVE_MODES}.")
+    return CountingDraftModel(draft_model)
@@ -0,0 +1,210 @@
+# stream_pipeline.py
+
+import asyncio
+import inspect
+import queue
+import re
+import string
+import sys
+import time
+from typing import Any, AsyncGenerator, Generator, Iterable, List, Optional, TextIO
+
+
+# compiled once; a single C-level search per token instead of a Python loop over its characters
+BOUNDARY_PATTERN = re.compile(f"[{re.escape(string.whitespace + string.punctuation)}]")
+
+
+def coalesce_tokens(
+    tokens: Iterable[str],
+    word_boundary: bool = True,
+    max_bytes: Optional[int] = None,
+    interval: Optional[float] = None,
+) -> Generator[str, None, None]:
+    """
+    Groups streamed tokens into larger chunks, so consumers are called per word or per batch of text
+    instead of per token. A chunk is emitted as soon as any of the enabled conditions holds.
+
+    Parameters
+    ----------
+    tokens : Iterable[str]
+        The streamed tokens, e.g. LLM.stream or a TextIteratorStreamer.
+    word_boundary : bool, optional
+        Emit after a token containing whitespace or punctuation (default is True).
+    max_bytes : int, optional
+        Emit when the chunk reaches this many UTF-8 bytes (default is None).
+    interval : float, optional
+        Emit when this many seconds passed since the last chunk (default is None).
+
+    Yields
+    ------
+    str
+        The chunks; together exactly the concatenated tokens.
+    """
+    parts: List[str] = []
+    size = 0
+    last = time.monotonic() if interval is not None else 0.0
+    for token in tokens:
+        if not token:
+            continue
+        parts.append(token)
+        flush = word_boundary and BOUNDARY_PATTERN.search(token) is not None
+        if max_bytes is not None:
+            size += len(token.encode("utf-8"))
+            flush = flush or size >= max_bytes
+        if interval is not None and not flush:
+            flush = time.monotonic() - last >= interval
+        if flush:
+            yield "".join(parts)
+            parts = []
+            size = 0
+            if interval is not None:
+                last = time.monotonic()
+    if parts:
+        yield "".join(parts)
+
+
+class ConsoleSink:
+    def __init__(self, stream: TextIO = sys.stdout, newline_on_close: bool = True):
+        self.stream = stream
+        self.newline_on_close = newline_on_close
+
+    def write(self, chunk: str) -> None:
+        self.stream.write(chunk)
+        self.stream.flush()
+
+    def close(self) -> None:
+        if self.newline_on_close:
+            self.stream.write("\n")
+            self.stream.flush()
+
+
+class FileSink:
+    def __init__(self, file_path: str, mode: str = "w"):
+        self.file = open(file_path, mode, encoding="utf-8")
+
+    def write(self, chunk: str) -> None:
+        self.file.write(chunk)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class QueueSink:
+    def __init__(self, output: queue.Queue, end: Any = None):
+        """
+        Puts chunks on a thread queue and end when the stream is done. A bounded queue (maxsize) blocks
+        the producer while the consumer is behind, which is the backpressure.
+        """
+        self.output = output
+        self.end = end
+
+    def write(self, chunk: str) -> None:
+        self.output.put(chunk)
+
+    def close(self) -> None:
+        self.output.put(self.end)
+
+
+class AsyncQueueSink:
+    def __init__(self, output: asyncio.Queue, end: Any = None):
+        """
+        The asyncio counterpart of QueueSink, for StreamPipeline.astream. A bounded queue suspends the
+        producer while the consumer is behind.
+        """
+        self.output = output
+        self.end = end
+
+    async def write(self, chunk: str) -> None:
+        await self.output.put(chunk)
+
+    async def close(self) -> None:
+        await self.output.put(self.end)
+
+
+class SSESink:
+    def __init__(self, stream: TextIO, event: Optional[str] = None):
+        """
+        Writes chunks as Server-Sent Events to a writable stream, e.g. an HTTP response body,
+        ending with a "done" event.
+        """
+        self.stream = stream
+        self.event = event
+
+    def write(self, chunk: str) -> None:
+        lines = [f"event: {self.event}"] if self.event else []
+        # every line of the data gets its own data field, the client joins them with newlines
+        lines.extend(f"data: {line}" for line in chunk.split("\n"))
+        self.stream.write("\n".join(lines) + "\n\n")
+        self.stream.flush()
+
+    def close(self) -> None:
+        self.stream.write("event: done\ndata: \n\n")
+        self.stream.flush()
+
+
+class StreamPipeline:
+    def __init__(
+        self,
+        sinks: Optional[List] = None,
+        word_boundary: bool = True,
+        max_bytes: Optional[int] = None,
+        interval: Optional[float] = None,
+    ):
+        """
+        Coalesces a token stream into chunks (see coalesce_tokens) and fans every chunk out to the sinks,
+        in order. A sink is any object with write(chunk) and close(), either plain or async; a blocking or
+        awaiting write slows down the stream, so slow consumers apply backpressure instead of buffering
+        without bound.
+
+        Parameters
+        ----------
+        sinks : List, optional
+            The sinks, e.g. ConsoleSink, FileSink, QueueSink, AsyncQueueSink or SSESink (default is None, no sinks).
+        word_boundary, max_bytes, interval
+            When to emit a chunk, see coalesce_tokens.
+        """
+        self.sinks = sinks or []
+        self.word_boundary = word_boundary
+        self.max_bytes = max_bytes
+        self.interval = interval
+
+    def _chunks(self, tokens: Iterable[str]) -> Generator[str, None, None]:
+        return coalesce_tokens(tokens, self.word_boundary, self.max_bytes, self.interval)
+
+    def stream(self, tokens: Iterable[str]) -> Generator[str, None, None]:
+        """
+        Yields the chunks after writing them to the sinks. The sinks are closed when the stream ends.
+        """
+        try:
+            for chunk in self._chunks(tokens):
+                for sink in self.sinks:
+                    sink.write(chunk)
+                yield chunk
+        finally:
+            for sink in self.sinks:
+                sink.close()
+
+    async def astream(self, tokens: Iterable[str]) -> AsyncGenerator[str, None]:
+        """
+        Like stream, for use in async code: async sinks are awaited, and control returns to the event loop
+        after every chunk.
+        """
+        try:
+            for chunk in self._chunks(tokens):
+                for sink in self.sinks:
+                    result = sink.write(chunk)
+                    if inspect.isawaitable(result):
+                        await result
+                yield chunk
+                await asyncio.sleep(0)
+        finally:
+            for sink in self.sinks:
+                result = sink.close()
+                if inspect.isawaitable(result):
+                    await result
+
+    def run(self, tokens: Iterable[str]) -> str:
+        """
+        Consumes the whole stream and returns the generated text.
+        """
+        return "".join(self.stream(tokens))
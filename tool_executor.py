@@ -0,0 +1,204 @@
+# tool_executor.py
+
+import asyncio
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+ASYNC = "async"
+IO_BOUND = "io"
+CPU_BOUND = "cpu"
+
+
+class Tool:
+    def __init__(
+        self,
+        function: Callable,
+        kind: str = ASYNC,
+        timeout: Optional[float] = None,
+        max_concurrency: Optional[int] = None,
+        pure: bool = False,
+    ):
+        """
+        Describes how a tool runs.
+
+        Parameters
+        ----------
+        function : Callable
+            The tool. A coroutine function for ASYNC tools, a plain function otherwise. CPU_BOUND tools
+            run in another process, so the function and its arguments must be picklable.
+        kind : str, optional
+            ASYNC runs the tool as a task on the event loop, IO_BOUND in the thread pool and CPU_BOUND in the
+            process pool (default is ASYNC).
+        timeout : float, optional
+            The seconds after which a call fails with asyncio.TimeoutError (default is None, no timeout).
+            A timed out thread or process call keeps running in its pool, but its result is discarded.
+        max_concurrency : int, optional
+            The maximum number of simultaneous calls of the tool (default is None, unlimited).
+        pure : bool, optional
+            Whether the result only depends on the arguments, so results are cached by arguments
+            and identical concurrent calls share one execution (default is False).
+        """
+        if kind not in (ASYNC, IO_BOUND, CPU_BOUND):
+            raise ValueError(f"Invalid tool kind: {kind}. Expected one of {ASYNC}, {IO_BOUND}, {CPU_BOUND}.")
+        self.function = function
+        self.kind = kind
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.pure = pure
+
+
+class ToolExecutor:
+    def __init__(self, tools: Dict[str, Tool], max_threads: int = 8, max_processes: int = 2):
+        """
+        Runs tool calls concurrently, each in the place that suits it: coroutines on the event loop,
+        blocking I/O in a thread pool and CPU-heavy work in a process pool. The event loop stays free,
+        so generation can continue while tools run, and a turn with several tool calls takes as long
+        as its slowest call instead of their sum.
+
+        Parameters
+        ----------
+        tools : Dict[str, Tool]
+            The tools by name.
+        max_threads : int, optional
+            The size of the thread pool for IO_BOUND tools (default is 8).
+        max_processes : int, optional
+            The size of the process pool for CPU_BOUND tools, started on the first CPU_BOUND call (default is 2).
+        """
+        self.tools = tools
+        self.max_processes = max_processes
+        self.thread_pool = ThreadPoolExecutor(max_workers=max_threads)
+        self.process_pool: Optional[ProcessPoolExecutor] = None
+        # results of pure tools by arguments, which outlive the event loop they were computed on
+        self.cache: Dict[Tuple[str, str], Any] = {}
+        self.stats: Dict[str, Dict[str, float]] = {}
+        # futures and semaphores belong to the event loop they were created on, so they are kept
+        # per loop and replaced when the executor is used from another one, e.g. a new asyncio.run
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._in_flight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def _bind_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._in_flight = {}
+            self._semaphores = {}
+
+    def _semaphore(self, name: str) -> Optional[asyncio.Semaphore]:
+        limit = self.tools[name].max_concurrency
+        if limit is None:
+            return None
+        self._bind_loop()
+        if name not in self._semaphores:
+            self._semaphores[name] = asyncio.Semaphore(limit)
+        return self._semaphores[name]
+
+    async def _run(self, name: str, kwargs: Dict[str, Any]) -> Any:
+        tool = self.tools[name]
+        if tool.kind == ASYNC:
+            return await tool.function(**kwargs)
+        loop = asyncio.get_running_loop()
+        if tool.kind == IO_BOUND:
+            pool = self.thread_pool
+        else:
+            if self.process_pool is None:
+                self.process_pool = ProcessPoolExecutor(max_workers=self.max_processes)
+            pool = self.process_pool
+        return await loop.run_in_executor(pool, _call, tool.function, kwargs)
+
+    async def _execute(self, name: str, kwargs: Dict[str, Any]) -> Any:
+        tool = self.tools[name]
+        semaphore = self._semaphore(name)
+        start = time.time()
+        try:
+            if semaphore is None:
+                return await asyncio.wait_for(self._run(name, kwargs), tool.timeout)
+            async with semaphore:
+                return await asyncio.wait_for(self._run(name, kwargs), tool.timeout)
+        finally:
+            stats = self.stats.setdefault(name, {"calls": 0, "cache_hits": 0, "seconds": 0.0})
+            stats["calls"] += 1
+            stats["seconds"] += time.time() - start
+
+    async def call(self, name: str, **kwargs) -> Any:
+        """
+        Calls a tool and returns its result. Exceptions of the tool, and asyncio.TimeoutError when it
+        exceeds its timeout, are raised to the caller.
+        """
+        if name not in self.tools:
+            raise KeyError(f"Unknown tool: {name}. Available tools: {list(self.tools)}.")
+        if not self.tools[name].pure:
+            return await self._execute(name, kwargs)
+
+        key = (name, json.dumps(kwargs, sort_keys=True, default=repr))
+        self._bind_loop()
+        if key in self.cache:
+            self.stats.setdefault(name, {"calls": 0, "cache_hits": 0, "seconds": 0.0})["cache_hits"] += 1
+            return self.cache[key]
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._execute(name, kwargs))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda future: self._finish(key, future))
+        else:
+            self.stats.setdefault(name, {"calls": 0, "cache_hits": 0, "seconds": 0.0})["cache_hits"] += 1
+        # shielded, so a caller that is cancelled does not cancel the call other callers wait for
+        return await asyncio.shield(future)
+
+    def _finish(self, key: Tuple[str, str], future: asyncio.Future) -> None:
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+        # failures are not cached
+        if not future.cancelled() and future.exception() is None:
+            self.cache[key] = future.result()
+
+    async def call_many(self, calls: List[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """
+        Runs several tool calls in parallel.
+
+        Parameters
+        ----------
+        calls : List[Tuple[str, Dict[str, Any]]]
+            The (tool name, keyword arguments) of every call.
+
+        Returns
+        -------
+        List[Dict[str, Any]]
+            Per call, in the order of the calls, the name, result, error (None on success) and seconds.
+            A failing call does not affect the others.
+        """
+
+        async def timed(name: str, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+            start = time.time()
+            try:
+                result, error = await self.call(name, **kwargs), None
+            except asyncio.TimeoutError:
+                result, error = None, f"{name} timed out after {self.tools[name].timeout} seconds"
+            except Exception as e:
+                result, error = None, f"{type(e).__name__}: {e}"
+            return {"name": name, "result": result, "error": error, "seconds": time.time() - start}
+
+        return list(await asyncio.gather(*(timed(name, kwargs) for name, kwargs in calls)))
+
+    def clear_cache(self) -> None:
+        self.cache.clear()
+
+    def close(self) -> None:
+        """
+        Shuts down the thread and process pools.
+        """
+        self._loop = None
+        self._in_flight = {}
+        self._semaphores = {}
+        self.thread_pool.shutdown(wait=False, cancel_futures=True)
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=False, cancel_futures=True)
+            self.process_pool = None
+
+
+def _call(function: Callable, kwargs: Dict[str, Any]) -> Any:
+    # run_in_executor only passes positional arguments
+    return function(**kwargs)